@@ -0,0 +1,119 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import math
+import time
+
+from app.metrics import Histogram
+
+
+class OverloadedError(Exception):
+    """A request was shed, with the HTTP status and Retry-After to answer"""
+
+    def __init__(self, message: str, status_code: int, retry_after: int):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class Admission:
+    """A slot held by an admitted request; releasing it twice is harmless"""
+
+    def __init__(self, controller):
+        self._controller = controller
+
+    def release(self):
+        if self._controller is not None:
+            self._controller._release()
+            self._controller = None
+
+
+class AdmissionController:
+    """Bounds the requests of an endpoint that are processed at once.
+
+    Up to `max_concurrency` requests are processed, and up to `max_queue`
+    more wait for a slot in arrival order. A request arriving to a full
+    queue is rejected right away with status 429, and one that waited
+    `queue_timeout` seconds without getting a slot with status 503, before
+    it spends any embedding or LLM quota on a client that gave up.
+    """
+
+    def __init__(
+        self, name: str, max_concurrency: int, max_queue: int, queue_timeout: float
+    ):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        # The queue is about drained again by the time its deadline is up.
+        self.retry_after = max(1, math.ceil(queue_timeout))
+        self.active = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.queue_time = Histogram()
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def acquire(self) -> Admission:
+        if not self._semaphore.locked():
+            # A free slot is taken without suspending, so requests arriving
+            # together see each other's slots.
+            await self._semaphore.acquire()
+            self.queue_time.observe(0.0)
+        elif self.queued >= self.max_queue:
+            self.rejected += 1
+            raise OverloadedError(
+                f"Too many {self.name} requests, try again later.",
+                429,
+                self.retry_after,
+            )
+        else:
+            await self._wait()
+        self.active += 1
+        self.admitted += 1
+        return Admission(self)
+
+    async def _wait(self):
+        self.queued += 1
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            raise OverloadedError(
+                f"The {self.name} service is overloaded, try again later.",
+                503,
+                self.retry_after,
+            )
+        finally:
+            self.queued -= 1
+            self.queue_time.observe(time.perf_counter() - start)
+
+    def _release(self):
+        self.active -= 1
+        self._semaphore.release()
+
+    def stats(self):
+        return {
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "active": self.active,
+            "queued": self.queued,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "queue_time": self.queue_time.stats(),
+        }
@@ -0,0 +1,99 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import threading
+
+
+class BoundedExecutor:
+    """Runs blocking calls on a dedicated thread pool without blocking the
+    event loop.
+
+    At most `max_workers` calls run at once; additional callers wait on a
+    semaphore instead of piling up in the thread pool queue, so the number of
+    waiting callers can be observed.
+    """
+
+    def __init__(self, max_workers: int, name: str):
+        self.max_workers = max_workers
+        self.active = 0
+        self.waiting = 0
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=name
+        )
+        self._semaphore = asyncio.Semaphore(max_workers)
+
+    async def run(self, func, /, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        try:
+            return await loop.run_in_executor(
+                self._pool, functools.partial(func, *args, **kwargs)
+            )
+        finally:
+            self.active -= 1
+            self._semaphore.release()
+
+    async def stream(self, func, /, *args, **kwargs):
+        """Iterates a blocking iterator on the pool, yielding its items.
+
+        The iterator is consumed by a single worker thread which hands items
+        back to the event loop through a queue. If the consumer stops early
+        the worker stops at the next item.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        done = object()
+        stopped = threading.Event()
+
+        def produce():
+            try:
+                for item in func(*args, **kwargs):
+                    if stopped.is_set():
+                        break
+                    loop.call_soon_threadsafe(queue.put_nowait, (item, None))
+            except BaseException as e:
+                loop.call_soon_threadsafe(queue.put_nowait, (done, e))
+            else:
+                loop.call_soon_threadsafe(queue.put_nowait, (done, None))
+
+        producer = asyncio.ensure_future(self.run(produce))
+        try:
+            while True:
+                item, error = await queue.get()
+                if error is not None:
+                    raise error
+                if item is done:
+                    break
+                yield item
+        finally:
+            stopped.set()
+            producer.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        return {
+            "max_workers": self.max_workers,
+            "active": self.active,
+            "waiting": self.waiting,
+        }
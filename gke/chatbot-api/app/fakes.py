@@ -0,0 +1,147 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Deterministic local stand-ins for the Vertex AI embedding and LLM clients.
+
+They let the API run offline (for example against a local Postgres with
+pgvector) without Vertex AI quota. Enable them with FAKE_VERTEXAI=true.
+FakeCredentials likewise stands in for the IAM credentials.
+"""
+
+import datetime
+import hashlib
+import re
+import time
+from typing import Any, Iterator, List, Optional
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.llms import LLM
+from langchain_core.outputs import GenerationChunk
+import numpy as np
+
+
+class FakeEmbeddings(Embeddings):
+    """Bag-of-words hashing embeddings.
+
+    Every word maps to a fixed pseudo-random vector, so texts sharing words
+    have a high cosine similarity. Each call sleeps for `latency` seconds to
+    mimic a network round trip.
+    """
+
+    def __init__(self, dimensions: int = 768, latency: float = 0.0):
+        self.dimensions = dimensions
+        self.latency = latency
+
+    def _embed_one(self, text: str) -> List[float]:
+        v = np.zeros(self.dimensions)
+        for word in re.findall(r"\w+", text.lower()):
+            seed = int.from_bytes(hashlib.sha256(word.encode()).digest()[:8], "big")
+            v += np.random.default_rng(seed).standard_normal(self.dimensions)
+        norm = np.linalg.norm(v)
+        if norm == 0:
+            v[0], norm = 1.0, 1.0
+        return (v / norm).tolist()
+
+    def embed(
+        self, texts: List[str], batch_size: int = 0, embeddings_task_type=None
+    ) -> List[List[float]]:
+        if self.latency:
+            time.sleep(self.latency)
+        return [self._embed_one(t) for t in texts]
+
+    def embed_documents(self, texts: List[str], batch_size: int = 0):
+        return self.embed(texts, batch_size, "RETRIEVAL_DOCUMENT")
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed([text], 1, "RETRIEVAL_QUERY")[0]
+
+
+class FakeLLM(LLM):
+    """An LLM that answers with the first words of its input text.
+
+    `latency` is spent before the first token and `token_latency` between
+    tokens, so both blocking and streaming calls can be exercised.
+    """
+
+    latency: float = 0.0
+    token_latency: float = 0.0
+    max_words: int = 40
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-vertexai"
+
+    def get_num_tokens(self, text: str) -> int:
+        return len(text.split())
+
+    def _words(self, prompt: str) -> List[str]:
+        # The prompts enclose their input text in the last pair of fences.
+        parts = prompt.split("```")
+        text = parts[-2] if len(parts) >= 3 else prompt
+        return text.split()[: self.max_words]
+
+    def _call(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> str:
+        return "".join(chunk.text for chunk in self._stream(prompt))
+
+    def _stream(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> Iterator[GenerationChunk]:
+        if self.latency:
+            time.sleep(self.latency)
+        for i, word in enumerate(self._words(prompt)):
+            if i and self.token_latency:
+                time.sleep(self.token_latency)
+            chunk = GenerationChunk(text=word if i == 0 else " " + word)
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+
+class FakeCredentials:
+    """Stands in for google.auth credentials in tests of the token refresh.
+
+    Every token expires `lifetime` seconds after it was issued. Each refresh
+    sleeps for `latency` seconds, and the next `failures` refreshes fail.
+    """
+
+    def __init__(
+        self, lifetime: float = 3600.0, latency: float = 0.0, failures: int = 0
+    ):
+        self.lifetime = lifetime
+        self.latency = latency
+        self.failures = failures
+        self.refreshes = 0
+        self.token = None
+        self.expiry = None
+
+    def refresh(self, request):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failures:
+            self.failures -= 1
+            raise Exception("fake credentials refresh failure")
+        self.refreshes += 1
+        self.token = f"fake-token-{self.refreshes}"
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        self.expiry = now + datetime.timedelta(seconds=self.lifetime)
@@ -14,19 +14,44 @@
 
 import asyncio
 from contextlib import asynccontextmanager
+from dataclasses import dataclass
+import json
 import os
-from typing import Union
+import secrets
+import time
+from typing import List, Literal, Union
 
 import asyncpg
-from fastapi import FastAPI, Request
-import google.auth
-from google.auth.transport.requests import Request as GRequest
-from google.cloud import aiplatform
-from langchain.chains.summarize import load_summarize_chain
-from langchain_core.documents import Document
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from langchain_core.prompts import PromptTemplate
-from langchain_google_vertexai import VertexAI, VertexAIEmbeddings
 from pgvector.asyncpg import register_vector
+from pydantic import BaseModel, Field
+from starlette.background import BackgroundTask
+
+from app.admission import AdmissionController, OverloadedError
+from app.batcher import MicroBatcher
+from app.cache import LRUCache, normalize_query, SemanticCache
+from app.deadline import (
+    ClientDisconnected,
+    deadline_events,
+    DeadlineExceeded,
+    remaining,
+    run_with_deadline,
+    set_deadline,
+    without_deadline,
+)
+from app.executor import BoundedExecutor
+from app.generation import DatasetGeneration
+from app.iam import TokenRefresher
+from app.metrics import Histogram, prometheus_gauge, prometheus_histogram, Timer
+from app.profiler import dump_tasks, ProfilerBusyError, SamplingProfiler
+from app.replicas import parse_hosts, ReadRouter
+from app.shared_cache import decode_floats, encode_floats, SharedCache
+from app.singleflight import SingleFlight
+from app.snapshot import SearchSnapshot
+from app.startup import StartupReport
 
 
 REGION = os.getenv("REGION")
@@ -34,66 +59,821 @@ PROJECT_ID = os.getenv("PROJECT_ID")
 DB_HOST = os.getenv("DB_HOST")
 DB_USER = os.getenv("DB_USER")
 DB_NAME = os.getenv("DB_NAME")
+# A fixed password and SSL mode for databases without IAM authentication,
+# such as a local Postgres used for benchmarks. By default the password is an
+# IAM access token.
+DB_PASSWORD = os.getenv("DB_PASSWORD")
+DB_SSL = os.getenv("DB_SSL", "require")
+# The IAM token is refreshed in the background DB_TOKEN_REFRESH_MARGIN seconds
+# before it expires.
+DB_TOKEN_REFRESH_MARGIN = float(os.getenv("DB_TOKEN_REFRESH_MARGIN", "300"))
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_MAX_INACTIVE_LIFETIME = float(os.getenv("DB_POOL_MAX_INACTIVE_LIFETIME", "300"))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+# Optional comma separated read replicas of DB_HOST, as host or host:port,
+# that serve the vector searches. Writes and metadata reads stay on DB_HOST,
+# which also serves the searches while no replica is healthy.
+DB_READ_HOSTS = parse_hosts(os.getenv("DB_READ_HOSTS", ""))
+# Replicas are health checked every DB_READ_CHECK_INTERVAL seconds. One is
+# ejected for DB_READ_EJECT_SECONDS after DB_READ_MAX_FAILURES consecutive
+# failures, or when its average read latency exceeds DB_READ_SLOW_THRESHOLD.
+DB_READ_CHECK_INTERVAL = float(os.getenv("DB_READ_CHECK_INTERVAL", "5"))
+DB_READ_MAX_FAILURES = int(os.getenv("DB_READ_MAX_FAILURES", "3"))
+DB_READ_SLOW_THRESHOLD = float(os.getenv("DB_READ_SLOW_THRESHOLD", "2"))
+DB_READ_EJECT_SECONDS = float(os.getenv("DB_READ_EJECT_SECONDS", "30"))
+# The vector index returns SEARCH_OVERFETCH candidate chunks per requested
+# product. hnsw.ef_search bounds how many rows an HNSW scan can return, so it
+# should be at least the number of matches times SEARCH_OVERFETCH.
+SEARCH_OVERFETCH = int(os.getenv("SEARCH_OVERFETCH", "4"))
+SEARCH_HNSW_EF_SEARCH = int(os.getenv("SEARCH_HNSW_EF_SEARCH", "100"))
+SEARCH_IVFFLAT_PROBES = int(os.getenv("SEARCH_IVFFLAT_PROBES", "10"))
+# What the load-embeddings job built the vector indexes on, its
+# EMBEDDING_STORAGE: "vector", "halfvec" or "binary". A quantized index scan
+# returns SEARCH_RERANK_FACTOR times as many candidate chunks, which are then
+# reranked by their exact distance. Binary codes lose more precision, so they
+# need more candidates for the same recall.
+EMBEDDING_STORAGE = os.getenv("EMBEDDING_STORAGE", "vector")
+SEARCH_RERANK_FACTOR = int(
+    os.getenv("SEARCH_RERANK_FACTOR", "8" if EMBEDDING_STORAGE == "binary" else "2")
+)
+# Recall/latency tiers a request can pick, as (candidate chunks per requested
+# product, hnsw.ef_search). Every tier rescans when its candidates hold fewer
+# than k matches. "fast" lowers ef_search, down to the candidate chunks it
+# needs, so it explores less of the graph than "balanced" when k is small,
+# at the cost of setting it in a transaction. The tiers leave ivfflat.probes
+# alone: changing it makes the planner switch between the HNSW and IVFFlat
+# indexes.
+SEARCH_MODES = {
+    "fast": (SEARCH_OVERFETCH, 40),
+    "balanced": (SEARCH_OVERFETCH, SEARCH_HNSW_EF_SEARCH),
+    "accurate": (SEARCH_OVERFETCH, 400),
+}
+# The largest hnsw.ef_search pgvector accepts.
+HNSW_MAX_EF_SEARCH = 1000
+# A search whose candidates hold too few matches scans the index again for
+# SEARCH_RESCAN_GROWTH times as many, until hnsw.ef_search cannot cover them,
+# before it falls back to an exact scan of every chunk.
+SEARCH_RESCAN_GROWTH = 4
+# The most queries a single /search/batch request may carry.
+SEARCH_BATCH_MAX_QUERIES = int(os.getenv("SEARCH_BATCH_MAX_QUERIES", "100"))
+EMBEDDING_MODEL = "textembedding-gecko@003"
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "1024"))
+EMBEDDING_CACHE_TTL = float(os.getenv("EMBEDDING_CACHE_TTL", "3600"))
+# Optional file with one frequent query per line, embedded at startup.
+EMBEDDING_CACHE_WARMUP_FILE = os.getenv("EMBEDDING_CACHE_WARMUP_FILE")
+# The Vertex AI clients are synchronous, so their calls run on bounded thread
+# pools to keep the event loop free to serve other requests.
+EMBEDDING_MAX_CONCURRENCY = int(os.getenv("EMBEDDING_MAX_CONCURRENCY", "8"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+# Query texts to embed that arrive within EMBEDDING_BATCH_WINDOW seconds of
+# each other are sent in a single embedding request of at most
+# EMBEDDING_BATCH_MAX_SIZE texts.
+EMBEDDING_BATCH_WINDOW = float(os.getenv("EMBEDDING_BATCH_WINDOW", "0.005"))
+EMBEDDING_BATCH_MAX_SIZE = int(os.getenv("EMBEDDING_BATCH_MAX_SIZE", "32"))
+# The chatbot map step summarizes up to MAP_CONCURRENCY products at once per
+# request. Summaries taking longer than MAP_TIMEOUT seconds or failing are
+# dropped. Once MAP_MIN_SUMMARIES are in, stragglers get MAP_QUORUM_GRACE
+# more seconds before the combine step starts without them.
+MAP_CONCURRENCY = int(os.getenv("MAP_CONCURRENCY", "8"))
+MAP_TIMEOUT = float(os.getenv("MAP_TIMEOUT", "15"))
+MAP_MIN_SUMMARIES = int(os.getenv("MAP_MIN_SUMMARIES", "5"))
+MAP_QUORUM_GRACE = float(os.getenv("MAP_QUORUM_GRACE", "2"))
+# Search results are cached until the load-embeddings job records a new
+# dataset generation, which is polled every DATASET_GENERATION_POLL_INTERVAL.
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "1024"))
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "0"))
+DATASET_GENERATION_POLL_INTERVAL = float(
+    os.getenv("DATASET_GENERATION_POLL_INTERVAL", "30")
+)
+# Optional directory, preferably in memory such as /dev/shm/cache, where all
+# the uvicorn workers of a container share the embedding and result caches,
+# instead of each keeping its own. It is created if missing, and must only be
+# accessible to the user running the workers. Each entry takes a slot of
+# SHARED_CACHE_EMBEDDING_SLOT_SIZE or SHARED_CACHE_RESULT_SLOT_SIZE bytes;
+# larger entries are not cached.
+SHARED_CACHE_DIR = os.getenv("SHARED_CACHE_DIR")
+SHARED_CACHE_EMBEDDING_SLOT_SIZE = int(
+    os.getenv("SHARED_CACHE_EMBEDDING_SLOT_SIZE", "8192")
+)
+SHARED_CACHE_RESULT_SLOT_SIZE = int(os.getenv("SHARED_CACHE_RESULT_SLOT_SIZE", "65536"))
+# Optional directory of search snapshots exported by the load-embeddings job
+# (its SNAPSHOT_DIR). When set, vector searches run in process against the
+# memory-mapped snapshot of the current dataset generation, and in Postgres
+# whenever that snapshot is missing.
+SEARCH_SNAPSHOT_DIR = os.getenv("SEARCH_SNAPSHOT_DIR")
+# Chatbot answers are reused for paraphrased questions whose embeddings lie
+# within SEMANTIC_CACHE_MAX_DISTANCE cosine distance of a cached question.
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "256"))
+SEMANTIC_CACHE_MAX_DISTANCE = float(os.getenv("SEMANTIC_CACHE_MAX_DISTANCE", "0.05"))
+# Each endpoint processes at most *_MAX_CONCURRENCY requests at once, while up
+# to *_MAX_QUEUE more wait up to *_QUEUE_TIMEOUT seconds for their turn.
+# Requests beyond that are shed with 429 or 503 and a Retry-After header.
+# /search/batch shares the limits of /search, and /chatbot/stream those of
+# /chatbot, whose LLM calls are the scarcest resource.
+SEARCH_MAX_CONCURRENCY = int(os.getenv("SEARCH_MAX_CONCURRENCY", "64"))
+SEARCH_MAX_QUEUE = int(os.getenv("SEARCH_MAX_QUEUE", "256"))
+SEARCH_QUEUE_TIMEOUT = float(os.getenv("SEARCH_QUEUE_TIMEOUT", "2"))
+CHATBOT_MAX_CONCURRENCY = int(os.getenv("CHATBOT_MAX_CONCURRENCY", "16"))
+CHATBOT_MAX_QUEUE = int(os.getenv("CHATBOT_MAX_QUEUE", "32"))
+CHATBOT_QUEUE_TIMEOUT = float(os.getenv("CHATBOT_QUEUE_TIMEOUT", "5"))
+# Requests are cancelled after SEARCH_REQUEST_TIMEOUT or CHATBOT_REQUEST_TIMEOUT
+# seconds, or the seconds given in their X-Request-Timeout header, up to
+# REQUEST_TIMEOUT_MAX. The time left bounds their queries and LLM calls.
+SEARCH_REQUEST_TIMEOUT = float(os.getenv("SEARCH_REQUEST_TIMEOUT", "10"))
+CHATBOT_REQUEST_TIMEOUT = float(os.getenv("CHATBOT_REQUEST_TIMEOUT", "60"))
+REQUEST_TIMEOUT_MAX = float(os.getenv("REQUEST_TIMEOUT_MAX", "300"))
+# Instead of shedding chatbot requests, answer them with the search matches
+# only, without calling the LLM.
+CHATBOT_DEGRADED_MODE = os.getenv("CHATBOT_DEGRADED_MODE", "false").lower() == "true"
+# Token expected in the X-Admin-Token header by the /admin endpoints, which
+# are disabled when it is not set. A separate header is used because Cloud
+# Run authentication takes the Authorization header.
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+PROFILE_MAX_SECONDS = 60
+# Use deterministic local stand-ins instead of Vertex AI, e.g. for offline
+# testing against a local database.
+FAKE_VERTEXAI = os.getenv("FAKE_VERTEXAI", "false").lower() == "true"
+# Simulated latencies of the fake clients in seconds: per embedding request,
+# before the first LLM token and between LLM tokens.
+FAKE_EMBEDDING_LATENCY = float(os.getenv("FAKE_EMBEDDING_LATENCY", "0"))
+FAKE_LLM_LATENCY = float(os.getenv("FAKE_LLM_LATENCY", "0"))
+FAKE_LLM_TOKEN_LATENCY = float(os.getenv("FAKE_LLM_TOKEN_LATENCY", "0"))
+# Before accepting requests, embed STARTUP_WARMUP_QUERY and run its search on
+# each of the DB_POOL_MIN_SIZE pool connections.
+STARTUP_WARMUP = os.getenv("STARTUP_WARMUP", "true").lower() == "true"
+STARTUP_WARMUP_QUERY = os.getenv("STARTUP_WARMUP_QUERY", "toys for kids")
 
-aiplatform.init(project=f"{PROJECT_ID}", location=f"{REGION}")
-llm = VertexAI()
-embeddings_service = VertexAIEmbeddings(
-    model_name="textembedding-gecko@003",
+# The Vertex AI clients and the database credentials are created during
+# startup, concurrently with the connection pool (see lifespan).
+llm = None
+embeddings_service = None
+token_refresher = None
+embedding_cache = (
+    SharedCache(
+        os.path.join(SHARED_CACHE_DIR, "embeddings.cache"),
+        EMBEDDING_CACHE_SIZE,
+        SHARED_CACHE_EMBEDDING_SLOT_SIZE,
+        EMBEDDING_CACHE_TTL,
+        encode_floats,
+        decode_floats,
+    )
+    if SHARED_CACHE_DIR
+    else LRUCache(EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_TTL)
+)
+embedding_executor = BoundedExecutor(EMBEDDING_MAX_CONCURRENCY, "embedding")
+llm_executor = BoundedExecutor(LLM_MAX_CONCURRENCY, "llm")
+embedding_batcher = MicroBatcher(
+    lambda texts: embedding_executor.run(
+        embeddings_service.embed, texts, 0, "RETRIEVAL_QUERY"
+    ),
+    EMBEDDING_BATCH_WINDOW,
+    EMBEDDING_BATCH_MAX_SIZE,
+)
+# Coalesced searches run without the deadline of the request that started
+# them, as they also answer requests with later deadlines.
+search_flight = SingleFlight(without_deadline)
+result_cache = (
+    SharedCache(
+        os.path.join(SHARED_CACHE_DIR, "results.cache"),
+        RESULT_CACHE_SIZE,
+        SHARED_CACHE_RESULT_SLOT_SIZE,
+        RESULT_CACHE_TTL,
+    )
+    if SHARED_CACHE_DIR
+    else LRUCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
 )
+dataset_generation = DatasetGeneration("products", DATASET_GENERATION_POLL_INTERVAL)
+answer_cache = SemanticCache(SEMANTIC_CACHE_SIZE, SEMANTIC_CACHE_MAX_DISTANCE)
+if not SHARED_CACHE_DIR:
+    # Shared results are left to age out rather than cleared by each worker
+    # in turn, as their keys include the generation too.
+    dataset_generation.on_change(lambda _: result_cache.clear())
+dataset_generation.on_change(lambda _: answer_cache.clear())
+search_snapshot = (
+    SearchSnapshot(SEARCH_SNAPSHOT_DIR, DATASET_GENERATION_POLL_INTERVAL)
+    if SEARCH_SNAPSHOT_DIR
+    else None
+)
+if search_snapshot is not None:
+    dataset_generation.on_change(search_snapshot.load)
+map_step_stats = {
+    "stored": 0,
+    "summarized": 0,
+    "failed": 0,
+    "timed_out": 0,
+    "abandoned": 0,
+}
+stream_ttfb = Histogram()
+stream_ttft = Histogram()
+# Latency of each stage of the search and chatbot requests, for /metrics.
+stage_latency = {
+    stage: Histogram()
+    for stage in (
+        "embedding",
+        "pool_acquire",
+        "vector_query",
+        "snapshot_search",
+        "search",
+        "map_step",
+        "combine_step",
+        "chatbot",
+    )
+}
+pool_stats = {"waiters": 0}
+search_admission = AdmissionController(
+    "search", SEARCH_MAX_CONCURRENCY, SEARCH_MAX_QUEUE, SEARCH_QUEUE_TIMEOUT
+)
+chatbot_admission = AdmissionController(
+    "chatbot", CHATBOT_MAX_CONCURRENCY, CHATBOT_MAX_QUEUE, CHATBOT_QUEUE_TIMEOUT
+)
+degraded_stats = {"chatbot": 0}
+cancelled_requests = {
+    (endpoint, reason): 0
+    for endpoint in ("search", "chatbot")
+    for reason in ("deadline", "disconnect")
+}
+profiler = SamplingProfiler()
+
+
+async def embed_query(q):
+    """
+    Embeds the query text, reusing the vector of a previously seen query
+
+    Queries missing from the cache are embedded together with the other
+    queries arriving at about the same time.
+    """
+    with Timer(stage_latency["embedding"]):
+        key = (EMBEDDING_MODEL, normalize_query(q))
+        qe = embedding_cache.get(key)
+        if qe is None:
+            qe = await embedding_batcher.submit(q)
+            embedding_cache.put(key, qe)
+        return qe
 
 
-async def find_by_query(pool, q):
+async def embed_queries(queries):
+    """
+    Embeds many normalized query texts, sending those not cached yet to the
+    embedding service in a single request
+    """
+    vectors = {q: embedding_cache.get((EMBEDDING_MODEL, q)) for q in queries}
+    missing = [q for q, qe in vectors.items() if qe is None]
+    if missing:
+        embedded = await embedding_executor.run(
+            embeddings_service.embed, missing, 0, "RETRIEVAL_QUERY"
+        )
+        for q, qe in zip(missing, embedded):
+            embedding_cache.put((EMBEDDING_MODEL, q), qe)
+            vectors[q] = qe
+    return [vectors[q] for q in queries]
+
+
+async def warm_embedding_cache(path):
+    """Embeds the frequent queries listed in `path` in a single request"""
+    with open(path) as f:
+        queries = list(dict.fromkeys(normalize_query(line) for line in f))
+    queries = [q for q in queries if q]
+    if queries:
+        await embed_queries(queries)
+
+
+@dataclass(frozen=True)
+class SearchParams:
+    """Parameters of a similarity search, hashable so they can key caches"""
+
+    min_price: float = 25
+    max_price: float = 100
+    similarity_threshold: float = 0.1
+    num_matches: int = 25
+    mode: str = "balanced"
+    retrieval: str = "vector"
+
+
+def search_params(
+    k: int = Query(25, ge=1, le=100),
+    min_price: float = Query(25, ge=0),
+    max_price: float = Query(100, ge=0),
+    similarity_threshold: float = Query(0.1, ge=-1, le=1),
+    mode: Literal["fast", "balanced", "accurate"] = "balanced",
+    retrieval: Literal["vector", "hybrid"] = "vector",
+):
+    """Validates the search parameters of a request"""
+    if min_price > max_price:
+        raise HTTPException(
+            status_code=422, detail="min_price must not be greater than max_price"
+        )
+    return SearchParams(min_price, max_price, similarity_threshold, k, mode, retrieval)
+
+
+async def find_by_query(reads, q, params=SearchParams()):
     """
     Finding similar toy products using pgvector cosine search operator
+
+    Results are cached per dataset generation, and concurrent identical
+    searches share a single embedding and SQL execution.
+    """
+    with Timer(stage_latency["search"]):
+        key = (normalize_query(q), params)
+        matches = result_cache.get((dataset_generation.value, key))
+        if matches is not None:
+            return matches
+        return await search_flight.do(key, search_products, reads, q, params)
+
+
+async def find_by_queries(reads, queries, params=SearchParams()):
+    """
+    Runs many searches at once
+
+    Cached results are reused, and all the remaining distinct queries share
+    a single embedding request and a single SQL statement. Returns, in the
+    order of `queries`, either {"matches": [...]} or {"error": "..."} for
+    each query, so one failing query does not fail the whole batch.
+    """
+    generation = dataset_generation.value
+    results = [None] * len(queries)
+    pending = {}
+    for i, q in enumerate(queries):
+        key = normalize_query(q)
+        if not key:
+            results[i] = {"error": "The query is empty."}
+            continue
+        matches = result_cache.get((generation, (key, params)))
+        if matches is not None:
+            results[i] = {"matches": matches}
+        else:
+            pending.setdefault(key, []).append(i)
+
+    if pending:
+        try:
+            found = await search_products_batch(reads, list(pending), params)
+        except Exception as e:
+            found = [e] * len(pending)
+        for indexes, matches in zip(pending.values(), found):
+            if isinstance(matches, Exception):
+                result = {"error": str(matches)}
+            else:
+                result = {"matches": matches}
+            for i in indexes:
+                results[i] = result
+    return results
+
+
+# The distance the index of each quantized EMBEDDING_STORAGE is ordered by.
+# Keep in sync with the indexes of the load-embeddings job.
+QUANTIZED_DISTANCES = {
+    "halfvec": "(e.embedding::halfvec(768)) <=> {query}::vector::halfvec(768)",
+    "binary": "(binary_quantize(e.embedding)::bit(768))"
+    " <~> binary_quantize({query}::vector)",
+}
+
+
+def nearest_chunks(query):
+    """
+    SQL selecting the product_id and distance of the $3 chunks nearest to
+    the `query` embedding, nearest first
+
+    With a quantized EMBEDDING_STORAGE, the compact index is scanned for
+    SEARCH_RERANK_FACTOR times as many chunks, and those are reranked by the
+    exact distance of their float embeddings.
+    """
+    if EMBEDDING_STORAGE == "vector":
+        return f"""
+      SELECT e.product_id, e.embedding <=> {query} AS distance
+      FROM product_embeddings e
+      ORDER BY e.embedding <=> {query}
+      LIMIT $3"""
+    if EMBEDDING_STORAGE not in QUANTIZED_DISTANCES:
+        raise Exception(f"Unknown EMBEDDING_STORAGE {EMBEDDING_STORAGE}")
+    distance = QUANTIZED_DISTANCES[EMBEDDING_STORAGE].format(query=query)
+    return f"""
+      SELECT e.product_id, e.embedding <=> {query} AS distance
+      FROM (
+        SELECT e.product_id, e.embedding
+        FROM product_embeddings e
+        ORDER BY {distance}
+        LIMIT $3 * {SEARCH_RERANK_FACTOR}
+      ) e
+      ORDER BY distance
+      LIMIT $3"""
+
+
+# Find similar products to the query using cosine similarity search
+# over all vector embeddings.
+# This new feature is provided by `pgvector`.
+#
+# The candidate chunks are ordered by the raw distance operator so that the
+# HNSW (or IVFFlat) index can serve them. The candidate set is over-fetched
+# and only then collapsed to distinct products and filtered by similarity
+# and price, because filtering first would force a sequential scan.
+#
+# The query text never changes, so asyncpg prepares it once per connection and
+# reuses the prepared statement from its statement cache afterwards.
+SEARCH_PRODUCTS_SQL = f"""
+    WITH candidates AS MATERIALIZED ({nearest_chunks("$1")}
+    ),
+    scanned AS (
+      SELECT count(*) AS candidates, max(distance) AS max_distance
+      FROM candidates
+    )
+    SELECT scanned.candidates, scanned.max_distance, matches.*
+    FROM scanned
+    LEFT JOIN LATERAL (
+      SELECT p.product_id, p.product_name, p.list_price, p.description
+      FROM (
+        SELECT product_id, min(distance) AS distance
+        FROM candidates
+        GROUP BY product_id
+      ) c
+      JOIN products p USING (product_id)
+      WHERE 1 - c.distance > $2
+      AND p.list_price >= $4 AND p.list_price <= $5
+      ORDER BY c.distance
+      LIMIT $6
+    ) matches ON true
+"""
+
+# The same search for a batch of query embeddings in one statement. Each
+# query's candidates come from its own index scan in the LATERAL subquery,
+# and every query is numbered by its position (from 1) in the array. asyncpg
+# would take the embeddings for a two-dimensional array, so they are passed
+# in their text form.
+BATCH_SEARCH_PRODUCTS_SQL = f"""
+    WITH queries AS (
+      SELECT i, embedding::vector AS embedding
+      FROM unnest($1::text[]) WITH ORDINALITY AS q(embedding, i)
+    ),
+    candidates AS MATERIALIZED (
+      SELECT q.i, c.product_id, c.distance
+      FROM queries q
+      CROSS JOIN LATERAL ({nearest_chunks("q.embedding")}
+      ) c
+    ),
+    scanned AS (
+      SELECT q.i, count(c.i) AS candidates, max(c.distance) AS max_distance
+      FROM queries q
+      LEFT JOIN candidates c USING (i)
+      GROUP BY q.i
+    )
+    SELECT scanned.i, scanned.candidates, scanned.max_distance, matches.*
+    FROM scanned
+    LEFT JOIN LATERAL (
+      SELECT p.product_id, p.product_name, p.list_price, p.description,
+        c.distance
+      FROM (
+        SELECT product_id, min(distance) AS distance
+        FROM candidates
+        WHERE candidates.i = scanned.i
+        GROUP BY product_id
+      ) c
+      JOIN products p USING (product_id)
+      WHERE 1 - c.distance > $2
+      AND p.list_price >= $4 AND p.list_price <= $5
+      ORDER BY c.distance
+      LIMIT $6
+    ) matches ON true
+    ORDER BY scanned.i, matches.distance
+"""
+
+# An exact search over every chunk, used when the filters are so selective
+# that even the largest index scan does not contain enough matching products.
+EXACT_SEARCH_PRODUCTS_SQL = """
+    SELECT p.product_id, p.product_name, p.list_price, p.description
+    FROM (
+      SELECT product_id, min(embedding <=> $1) AS distance
+      FROM product_embeddings
+      GROUP BY product_id
+    ) c
+    JOIN products p USING (product_id)
+    WHERE 1 - c.distance > $2
+    AND p.list_price >= $3 AND p.list_price <= $4
+    ORDER BY c.distance
+    LIMIT $5
+"""
+
+
+# Hybrid search: the ANN candidates and a full-text search over product
+# names and descriptions are ranked separately, each backed by its own
+# index, and merged with reciprocal rank fusion (RRF). 60 is the customary
+# RRF constant damping the influence of the top ranks. Both rankings only
+# hold products in the price range, so that out of range products take no
+# ranks from those in range. The parameters are those of
+# SEARCH_PRODUCTS_SQL, followed by the query text.
+def hybrid_search_sql(candidates):
+    """SQL of a hybrid search whose vector ranking is of the `candidates`"""
+    return f"""
+    WITH vector_candidates AS MATERIALIZED ({candidates}
+    ),
+    scanned AS (
+      SELECT count(*) AS candidates, max(distance) AS max_distance
+      FROM vector_candidates
+    ),
+    vector_ranked AS (
+      SELECT c.product_id, row_number() OVER (ORDER BY min(c.distance)) AS rank
+      FROM vector_candidates c
+      JOIN products p USING (product_id)
+      WHERE p.list_price >= $4 AND p.list_price <= $5
+      GROUP BY c.product_id
+      HAVING 1 - min(c.distance) > $2
+    ),
+    lexical_ranked AS (
+      SELECT product_id,
+        row_number() OVER (ORDER BY ts_rank_cd(search_tsv, query) DESC) AS rank
+      FROM products, websearch_to_tsquery('english', $7) query
+      WHERE search_tsv @@ query
+      AND list_price >= $4 AND list_price <= $5
+      ORDER BY rank
+      LIMIT $3
+    ),
+    fused AS (
+      SELECT product_id, sum(1.0 / (60 + rank)) AS score
+      FROM (
+        SELECT * FROM vector_ranked
+        UNION ALL
+        SELECT * FROM lexical_ranked
+      ) ranked
+      GROUP BY product_id
+    )
+    SELECT scanned.candidates, scanned.max_distance, matches.*
+    FROM scanned
+    LEFT JOIN LATERAL (
+      SELECT p.product_id, p.product_name, p.list_price, p.description
+      FROM fused f
+      JOIN products p USING (product_id)
+      ORDER BY f.score DESC
+      LIMIT $6
+    ) matches ON true
+"""
+
+
+HYBRID_SEARCH_PRODUCTS_SQL = hybrid_search_sql(nearest_chunks("$1"))
+# The hybrid search whose vector ranking covers every chunk, the fallback
+# of hybrid searches as EXACT_SEARCH_PRODUCTS_SQL is of vector ones.
+EXACT_HYBRID_SEARCH_PRODUCTS_SQL = hybrid_search_sql(
+    """
+      SELECT product_id, embedding <=> $1 AS distance
+      FROM product_embeddings"""
+)
+
+
+def index_rows(num_candidates):
+    """The rows an index scan returns for `num_candidates` candidate chunks"""
+    if EMBEDDING_STORAGE == "vector":
+        return num_candidates
+    return num_candidates * SEARCH_RERANK_FACTOR
+
+
+def search_settings(params):
+    """Returns the number of candidate chunks and the ef_search to use"""
+    # An HNSW scan returns at most ef_search rows, so it must cover the
+    # over-fetched candidates, and those to rerank, regardless of the mode.
+    overfetch, ef_search = SEARCH_MODES[params.mode]
+    num_candidates = params.num_matches * overfetch
+    ef_search = min(max(ef_search, index_rows(num_candidates)), HNSW_MAX_EF_SEARCH)
+    return num_candidates, ef_search
+
+
+# The ef_search init_connection sets: that of a default search with the
+# EMBEDDING_STORAGE, so that default searches need no transaction.
+CONNECTION_EF_SEARCH = search_settings(SearchParams())[1]
+
+
+@asynccontextmanager
+async def acquire(pool):
+    """Acquires a pool connection, measuring the wait and the waiters"""
+    pool_stats["waiters"] += 1
+    try:
+        with Timer(stage_latency["pool_acquire"]):
+            conn = await pool.acquire(timeout=remaining())
+    finally:
+        pool_stats["waiters"] -= 1
+    try:
+        yield conn
+    finally:
+        await pool.release(conn)
+
+
+@asynccontextmanager
+async def search_connection(reads, params):
+    """
+    Acquires a connection with the ef_search of the search, from the pool
+    the read router picks
+
+    The time the connection is in use counts as the vector query stage.
+    Searches needing the ef_search set by init_connection use the connection
+    as is; the others set theirs in a transaction. Queries are bounded by
+    the request deadline through their asyncpg timeout, which cancels them
+    on the server, and within a transaction also by statement_timeout.
     """
+    _, ef_search = search_settings(params)
+    async with reads.read() as pool, acquire(pool) as conn:
+        with Timer(stage_latency["vector_query"]):
+            if ef_search == CONNECTION_EF_SEARCH:
+                yield conn
+                return
+            timeout = remaining(REQUEST_TIMEOUT_MAX)
+            async with conn.transaction(readonly=True):
+                await conn.execute(
+                    f"""
+                    SET LOCAL hnsw.ef_search = {ef_search};
+                    SET LOCAL statement_timeout = {max(int(timeout * 1000), 1)};
+                    """
+                )
+                yield conn
+
 
-    min_price = 25
-    max_price = 100
-    similarity_threshold = 0.1
-    num_matches = 25
+def needs_more_candidates(results, scanned, num_candidates, params):
+    """
+    Fewer matches than requested are the true answer if the scan ran out of
+    rows before returning `num_candidates` chunks, or if its farthest
+    candidate already fails the threshold, as every chunk not scanned is even
+    farther away.
+    """
+    return (
+        len(results) < params.num_matches
+        and scanned["candidates"] >= num_candidates
+        and 1 - scanned["max_distance"] > params.similarity_threshold
+    )
 
-    qe = embeddings_service.embed_query(q)
 
-    async with pool.acquire() as conn:
-        await register_vector(conn)
+async def search_candidates(conn, q, qe, params, num_candidates, exact=False):
+    """
+    Runs the vector or hybrid search of `params` over `num_candidates`
+    candidate chunks, or over every chunk when `exact` is set for a hybrid
+    search. Returns the statistics of the scan and the matches.
+    """
+    args = (
+        qe,
+        params.similarity_threshold,
+        num_candidates,
+        params.min_price,
+        params.max_price,
+        params.num_matches,
+    )
+    if params.retrieval == "hybrid":
+        sql = EXACT_HYBRID_SEARCH_PRODUCTS_SQL if exact else HYBRID_SEARCH_PRODUCTS_SQL
+        args += (q,)
+    else:
+        sql = SEARCH_PRODUCTS_SQL
+    rows = await conn.fetch(sql, *args, timeout=remaining())
+    return rows[0], [r for r in rows if r["product_id"] is not None]
+
 
-        # Find similar products to the query using cosine similarity search
-        # over all vector embeddings.
-        # This new feature is provided by `pgvector`.
-        results = await conn.fetch(
-            """
-            WITH vector_matches AS (
-              SELECT product_id, 1 - (embedding <=> $1) AS similarity
-              FROM product_embeddings
-              WHERE 1 - (embedding <=> $1) > $2
-              ORDER BY similarity DESC
-              LIMIT $3
+async def rescan(conn, q, qe, params, results, scanned):
+    """
+    Completes a vector or hybrid search whose candidates held too few matches
+
+    The index is scanned again for SEARCH_RESCAN_GROWTH times as many
+    candidates, with ef_search raised to match, and only once a scan cannot
+    grow any further are all the chunks searched exactly. Hybrid searches
+    rank the full-text matches again along with them. ivfflat.probes is
+    left alone: raising it makes the planner prefer the IVFFlat index, whose
+    recall is lower than that of the HNSW index at the same row count.
+    """
+    num_candidates, ef_search = search_settings(params)
+    while needs_more_candidates(results, scanned, num_candidates, params):
+        if index_rows(num_candidates) >= HNSW_MAX_EF_SEARCH:
+            if params.retrieval == "hybrid":
+                _, results = await search_candidates(
+                    conn, q, qe, params, num_candidates, exact=True
+                )
+                return results
+            return await conn.fetch(
+                EXACT_SEARCH_PRODUCTS_SQL,
+                qe,
+                params.similarity_threshold,
+                params.min_price,
+                params.max_price,
+                params.num_matches,
+                timeout=remaining(),
             )
-            SELECT product_name, list_price, description FROM products
-            WHERE product_id IN (SELECT product_id FROM vector_matches)
-            AND list_price >= $4 AND list_price <= $5
-            """,
-            qe,
-            similarity_threshold,
-            num_matches,
-            min_price,
-            max_price,
-        )
-
-        if len(results) == 0:
-            raise Exception("Did not find any results. Adjust the query parameters.")
-
-        matches = []
-        for r in results:
-            # Collect the description for all the matched similar toy products.
-            matches.append(
-                {
-                    "product_name": r["product_name"],
-                    "description": r["description"],
-                    "list_price": round(r["list_price"], 2),
-                }
+        num_candidates = min(
+            num_candidates * SEARCH_RESCAN_GROWTH,
+            HNSW_MAX_EF_SEARCH // index_rows(1),
+        )
+        ef_search = max(ef_search, index_rows(num_candidates))
+        # Within the transaction of a search mode, this is a savepoint.
+        async with conn.transaction(readonly=True):
+            await conn.execute(f"SET LOCAL hnsw.ef_search = {ef_search}")
+            scanned, results = await search_candidates(
+                conn, q, qe, params, num_candidates
             )
-        return matches
+    return results
+
+
+def product_matches(results):
+    if len(results) == 0:
+        raise Exception("Did not find any results. Adjust the query parameters.")
+
+    matches = []
+    for r in results:
+        # Collect the description for all the matched similar toy products.
+        matches.append(
+            {
+                "product_id": r["product_id"],
+                "product_name": r["product_name"],
+                "description": r["description"],
+                "list_price": round(r["list_price"], 2),
+            }
+        )
+    return matches
+
+
+def snapshot_index(generation, params):
+    """Returns the in-process index to search, if it can serve the search"""
+    if search_snapshot is None or params.retrieval != "vector":
+        return None
+    return search_snapshot.get(generation)
+
+
+def search_snapshot_index(index, qe, params):
+    # An exact scan of a catalog this size takes about a millisecond, so it
+    # runs on the event loop rather than on a thread pool.
+    with Timer(stage_latency["snapshot_search"]):
+        return index.search(
+            qe,
+            params.min_price,
+            params.max_price,
+            params.similarity_threshold,
+            params.num_matches,
+        )
+
+
+async def search_products(reads, q, params):
+    # Read the generation before querying so that results racing with a
+    # reload are stored under the old generation and never served.
+    generation = dataset_generation.value
+    qe = await embed_query(q)
+
+    index = snapshot_index(generation, params)
+    if index is not None:
+        results = search_snapshot_index(index, qe, params)
+    else:
+        results = await search_products_in_db(reads, q, qe, params)
+
+    matches = product_matches(results)
+    result_cache.put((generation, (normalize_query(q), params)), matches)
+    return matches
+
+
+async def search_products_in_db(reads, q, qe, params):
+    num_candidates, _ = search_settings(params)
+    async with search_connection(reads, params) as conn:
+        scanned, results = await search_candidates(conn, q, qe, params, num_candidates)
+        return await rescan(conn, q, qe, params, results, scanned)
+
+
+async def search_products_batch(reads, queries, params):
+    """
+    Vector searches for many distinct normalized queries with one statement
+
+    Returns the matches of each query, or the exception explaining why it
+    has none.
+    """
+    generation = dataset_generation.value
+    vectors = await embed_queries(queries)
+
+    index = snapshot_index(generation, params)
+    if index is not None:
+        found = [search_snapshot_index(index, qe, params) for qe in vectors]
+    else:
+        found = await search_products_batch_in_db(reads, vectors, params)
+
+    results = []
+    for q, rows in zip(queries, found):
+        try:
+            matches = product_matches(rows)
+        except Exception as e:
+            results.append(e)
+            continue
+        result_cache.put((generation, (q, params)), matches)
+        results.append(matches)
+    return results
+
+
+async def search_products_batch_in_db(reads, vectors, params):
+    num_candidates, _ = search_settings(params)
+    async with search_connection(reads, params) as conn:
+        rows = await conn.fetch(
+            BATCH_SEARCH_PRODUCTS_SQL,
+            [str(list(qe)) for qe in vectors],
+            params.similarity_threshold,
+            num_candidates,
+            params.min_price,
+            params.max_price,
+            params.num_matches,
+            timeout=remaining(),
+        )
+        scanned = [None] * len(vectors)
+        found = [[] for _ in vectors]
+        for r in rows:
+            scanned[r["i"] - 1] = r
+            if r["product_id"] is not None:
+                found[r["i"] - 1].append(r)
+
+        for i, qe in enumerate(vectors):
+            found[i] = await rescan(conn, None, qe, params, found[i], scanned[i])
+    return found
 
 
 map_prompt_template = """
@@ -132,20 +912,20 @@ Answer:
 """
 
 
-async def find_by_chatbot(pool, q):
-    matches = await find_by_query(pool, q)
+map_prompt = PromptTemplate(
+    template=map_prompt_template,
+    input_variables=["text"],
+)
 
-    map_prompt = PromptTemplate(
-        template=map_prompt_template,
-        input_variables=["text"],
-    )
+combine_prompt = PromptTemplate(
+    template=combine_prompt_template,
+    input_variables=["text", "user_query"],
+)
 
-    combine_prompt = PromptTemplate(
-        template=combine_prompt_template,
-        input_variables=["text", "user_query"],
-    )
 
-    matches = [
+def product_descriptions(matches):
+    """Describes each matched toy product for the LLM"""
+    return [
         f"""
         The name of the toy is {r["product_name"]}.
         The price of the toy is ${round(r["list_price"], 2)}.
@@ -155,63 +935,768 @@ async def find_by_chatbot(pool, q):
         for r in matches
     ]
 
-    docs = [Document(page_content=t) for t in matches]
-    chain = load_summarize_chain(
-        llm,
-        chain_type="map_reduce",
-        map_prompt=map_prompt,
-        combine_prompt=combine_prompt,
+
+async def summarize_products(descriptions):
+    """
+    Summarizes each product description concurrently with the map prompt and
+    returns the summaries that made it in time, in their original order
+    """
+    semaphore = asyncio.Semaphore(MAP_CONCURRENCY)
+
+    async def summarize(description):
+        async with semaphore:
+            return await asyncio.wait_for(
+                llm_executor.run(llm.invoke, map_prompt.format(text=description)),
+                min(MAP_TIMEOUT, remaining(MAP_TIMEOUT)),
+            )
+
+    loop = asyncio.get_running_loop()
+    tasks = [asyncio.ensure_future(summarize(d)) for d in descriptions]
+    order = {task: i for i, task in enumerate(tasks)}
+    quorum = min(MAP_MIN_SUMMARIES, len(tasks))
+    summaries = {}
+    pending = set(tasks)
+    deadline = None
+    try:
+        while pending:
+            timeout = None if deadline is None else max(deadline - loop.time(), 0)
+            done, pending = await asyncio.wait(
+                pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done:
+                break
+            for task in done:
+                if isinstance(task.exception(), asyncio.TimeoutError):
+                    map_step_stats["timed_out"] += 1
+                elif task.exception() is not None:
+                    map_step_stats["failed"] += 1
+                else:
+                    map_step_stats["summarized"] += 1
+                    summaries[order[task]] = task.result()
+            if deadline is None and len(summaries) >= quorum:
+                deadline = loop.time() + MAP_QUORUM_GRACE
+    finally:
+        map_step_stats["abandoned"] += len(pending)
+        for task in pending:
+            task.cancel()
+
+    return [summaries[i] for i in sorted(summaries)]
+
+
+async def product_summaries(pool, matches):
+    """
+    The map step of the map_reduce summary
+
+    The map prompt does not depend on the question, so the load-embeddings job
+    precomputes a summary per product. Only products without a stored
+    summary are summarized at query time.
+    """
+    with Timer(stage_latency["map_step"]):
+        try:
+            async with acquire(pool) as conn:
+                rows = await conn.fetch(
+                    """
+                    SELECT product_id, summary FROM product_summaries
+                    WHERE product_id = ANY($1::text[])
+                    """,
+                    [r["product_id"] for r in matches],
+                    timeout=remaining(),
+                )
+        except asyncpg.UndefinedTableError:
+            rows = []
+        stored = {r["product_id"]: r["summary"] for r in rows}
+        map_step_stats["stored"] += len(stored)
+
+        summaries = [
+            stored[r["product_id"]] for r in matches if r["product_id"] in stored
+        ]
+        missing = [r for r in matches if r["product_id"] not in stored]
+        if missing:
+            summaries += await summarize_products(product_descriptions(missing))
+        if not summaries:
+            raise Exception("Could not summarize any of the matched products.")
+        return summaries
+
+
+def combine_prompt_for(summaries, q):
+    """The prompt of the combine step of the map_reduce summary"""
+    return combine_prompt.format(text="\n\n".join(summaries), user_query=q)
+
+
+async def find_by_chatbot(pool, reads, q, params=SearchParams()):
+    with Timer(stage_latency["chatbot"]):
+        generation = dataset_generation.value
+        qe = await embed_query(q)
+        answer = answer_cache.get(qe, generation, params)
+        if answer is not None:
+            return {"answer": answer}
+
+        matches = await find_by_query(reads, q, params)
+
+        summaries = await product_summaries(pool, matches)
+        with Timer(stage_latency["combine_step"]):
+            prompt = combine_prompt_for(summaries, q)
+            answer = await llm_executor.run(llm.invoke, prompt)
+        answer_cache.put(qe, answer, generation, params)
+        return {"answer": answer}
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(jsonable_encoder(data))}\n\n"
+
+
+async def stream_chatbot(pool, reads, q, params=SearchParams()):
+    """
+    Streams a chatbot answer as Server-Sent Events
+
+    The search matches are sent first, followed by the output of the combine
+    step token by token and finally the complete answer.
+    """
+    start = time.perf_counter()
+    generation = dataset_generation.value
+    try:
+        qe = await embed_query(q)
+        matches = await find_by_query(reads, q, params)
+    except Exception as e:
+        yield sse_event("error", str(e))
+        return
+
+    stream_ttfb.observe(time.perf_counter() - start)
+    yield sse_event("matches", matches)
+
+    answer = answer_cache.get(qe, generation, params)
+    if answer is not None:
+        stream_ttft.observe(time.perf_counter() - start)
+        yield sse_event("token", answer)
+        yield sse_event("done", answer)
+        return
+
+    try:
+        summaries = await product_summaries(pool, matches)
+    except Exception as e:
+        yield sse_event("error", str(e))
+        return
+
+    tokens = []
+    prompt = combine_prompt_for(summaries, q)
+    async for token in llm_executor.stream(llm.stream, prompt):
+        if not tokens:
+            stream_ttft.observe(time.perf_counter() - start)
+        tokens.append(token)
+        yield sse_event("token", token)
+
+    answer = "".join(tokens)
+    answer_cache.put(qe, answer, generation, params)
+    yield sse_event("done", answer)
+
+
+def init_vertexai():
+    """
+    Creates the LLM and embedding clients
+
+    The Vertex AI SDK takes seconds to import, so it is only imported here,
+    on a worker thread while the connection pool is being opened. So are the
+    fake clients, which import the LangChain language models.
+    """
+    global llm, embeddings_service
+    if FAKE_VERTEXAI:
+        from app.fakes import FakeEmbeddings, FakeLLM
+
+        llm = FakeLLM(latency=FAKE_LLM_LATENCY, token_latency=FAKE_LLM_TOKEN_LATENCY)
+        embeddings_service = FakeEmbeddings(latency=FAKE_EMBEDDING_LATENCY)
+        return
+
+    from google.cloud import aiplatform
+    from langchain_google_vertexai import VertexAI, VertexAIEmbeddings
+
+    aiplatform.init(project=f"{PROJECT_ID}", location=f"{REGION}")
+    llm = VertexAI()
+    embeddings_service = VertexAIEmbeddings(
+        model_name=EMBEDDING_MODEL,
     )
-    answer = chain.invoke(
-        {
-            "input_documents": docs,
-            "user_query": q,
-        }
+
+
+def load_credentials():
+    """Loads the IAM credentials whose access token is the database password"""
+    import google.auth
+    from google.auth.transport.requests import Request as GRequest
+
+    creds, _ = google.auth.default(
+        scopes=["https://www.googleapis.com/auth/sqlservice.login"]
     )
-    return {"answer": answer["output_text"]}
+    return TokenRefresher(creds, GRequest, margin=DB_TOKEN_REFRESH_MARGIN)
 
 
-creds, _ = google.auth.default(
-    scopes=["https://www.googleapis.com/auth/sqlservice.login"]
-)
+async def get_password():
+    """Returns the cached token, refreshed in the background by lifespan"""
+    if DB_PASSWORD is not None:
+        return DB_PASSWORD
+    return await token_refresher.token()
 
 
-def get_password():
-    if not creds.valid:
-        request = GRequest()
-        creds.refresh(request)
+async def init_connection(conn):
+    """Prepares each new pool connection once, rather than on every acquire"""
+    await register_vector(conn)
+    # No request waits longer than REQUEST_TIMEOUT_MAX for any statement.
+    await conn.execute(
+        f"""
+        SET hnsw.ef_search = {CONNECTION_EF_SEARCH};
+        SET ivfflat.probes = {SEARCH_IVFFLAT_PROBES};
+        SET statement_timeout = {int(REQUEST_TIMEOUT_MAX * 1000)};
+        """
+    )
 
-    return creds.token
 
+async def reset_connection(conn):
+    """
+    Skips the default reset query that asyncpg sends whenever a connection is
+    released, saving a round trip per request.
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    app.state.pool = await asyncpg.create_pool(
-        host=DB_HOST,
+    The app keeps no session state: it does not LISTEN, take advisory locks
+    or open cursors, and settings are only changed in init_connection or
+    with SET LOCAL.
+    Transactions left open are still rolled back by the pool.
+    """
+
+
+async def create_pool(host, port=None, min_size=DB_POOL_MIN_SIZE):
+    return await asyncpg.create_pool(
+        host=host,
+        port=port,
         user=DB_USER,
         password=get_password,
         database=DB_NAME,
-        ssl="require",
+        ssl=DB_SSL,
+        min_size=min_size,
+        max_size=DB_POOL_MAX_SIZE,
+        max_inactive_connection_lifetime=DB_POOL_MAX_INACTIVE_LIFETIME,
+        statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+        init=init_connection,
+        reset=reset_connection,
+    )
+
+
+async def create_read_pool(host, port, report):
+    try:
+        return await create_pool(host, port)
+    except Exception as e:
+        # Open its connections on demand instead, once it passes the health
+        # checks of the read router.
+        report.failed(f"read_pool {replica_name(host, port)}", e)
+        return await create_pool(host, port, min_size=0)
+
+
+async def create_pools(report):
+    """Opens the pool of DB_HOST and one pool per read replica"""
+    global token_refresher
+    if DB_PASSWORD is None:
+        token_refresher = await asyncio.to_thread(load_credentials)
+        await token_refresher.refresh()
+    return await asyncio.gather(
+        create_pool(DB_HOST),
+        *[create_read_pool(host, port, report) for host, port in DB_READ_HOSTS],
+    )
+
+
+def replica_name(host, port):
+    return host if port is None else f"{host}:{port}"
+
+
+async def warm_up(pool):
+    """
+    Embeds a query and runs its search on every connection the pool opened,
+    so that the first requests find the embedding client connected, the
+    search statement prepared on each connection and the index in memory
+    """
+    qe = await embed_query(STARTUP_WARMUP_QUERY)
+    params = SearchParams()
+    num_candidates, _ = search_settings(params)
+    conns = [await pool.acquire() for _ in range(DB_POOL_MIN_SIZE)]
+    try:
+        await asyncio.gather(
+            *[
+                conn.fetch(
+                    SEARCH_PRODUCTS_SQL,
+                    qe,
+                    params.similarity_threshold,
+                    num_candidates,
+                    params.min_price,
+                    params.max_price,
+                    params.num_matches,
+                )
+                for conn in conns
+            ]
+        )
+    finally:
+        for conn in conns:
+            await pool.release(conn)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    report = app.state.startup = StartupReport()
+    pools, _ = await asyncio.gather(
+        report.timed("db_pool", create_pools(report)),
+        report.timed("vertexai_clients", asyncio.to_thread(init_vertexai)),
     )
+    app.state.pool = pools[0]
+    app.state.reads = ReadRouter(
+        app.state.pool,
+        [
+            (replica_name(host, port), pool)
+            for (host, port), pool in zip(DB_READ_HOSTS, pools[1:])
+        ],
+        dataset_generation,
+        max_failures=DB_READ_MAX_FAILURES,
+        slow_threshold=DB_READ_SLOW_THRESHOLD,
+        eject_seconds=DB_READ_EJECT_SECONDS,
+        check_interval=DB_READ_CHECK_INTERVAL,
+    )
+    await report.timed("dataset_generation", dataset_generation.refresh(app.state.pool))
+    watcher = asyncio.create_task(dataset_generation.watch(app.state.pool))
+    if DB_READ_HOSTS:
+        await report.timed("read_replicas", app.state.reads.check_all())
+    checker = asyncio.create_task(app.state.reads.watch())
+    if search_snapshot is not None:
+        snapshot_watcher = asyncio.create_task(
+            search_snapshot.watch(dataset_generation)
+        )
+    if token_refresher is not None:
+        refresher = asyncio.create_task(token_refresher.run())
+    if EMBEDDING_CACHE_WARMUP_FILE:
+        await report.timed(
+            "embedding_cache", warm_embedding_cache(EMBEDDING_CACHE_WARMUP_FILE)
+        )
+    if STARTUP_WARMUP:
+        try:
+            # Replicas that failed their first health check are skipped.
+            warm = [app.state.pool] + [r.pool for r in app.state.reads.routable()]
+            await report.timed(
+                "warm_up", asyncio.gather(*[warm_up(pool) for pool in warm])
+            )
+        except Exception as e:
+            # A cold instance is still better than none.
+            report.failed("warm_up", e)
+    report.finish()
     yield
-    await asyncio.wait_for(app.state.pool.close(), 10)
+    watcher.cancel()
+    checker.cancel()
+    if search_snapshot is not None:
+        snapshot_watcher.cancel()
+    if token_refresher is not None:
+        refresher.cancel()
+    await asyncio.wait_for(asyncio.gather(*[pool.close() for pool in pools]), 10)
+    embedding_executor.shutdown()
+    llm_executor.shutdown()
 
 
 app = FastAPI(lifespan=lifespan)
 
 
+def overloaded(e):
+    return HTTPException(
+        status_code=e.status_code,
+        detail=str(e),
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
+
+@asynccontextmanager
+async def admitted(controller):
+    """Holds a slot of the endpoint for the request, or sheds the request"""
+    try:
+        admission = await controller.acquire()
+    except OverloadedError as e:
+        raise overloaded(e)
+    try:
+        yield
+    finally:
+        admission.release()
+
+
+async def admit_chatbot():
+    """
+    Admits a chatbot request, or in degraded mode lets a request the chatbot
+    would shed through as a search
+
+    Returns the admission and whether the request was degraded.
+    """
+    try:
+        return await chatbot_admission.acquire(), False
+    except OverloadedError as e:
+        if not CHATBOT_DEGRADED_MODE:
+            raise overloaded(e)
+    try:
+        admission = await search_admission.acquire()
+    except OverloadedError as e:
+        raise overloaded(e)
+    degraded_stats["chatbot"] += 1
+    return admission, True
+
+
+async def stream_matches(reads, q, params):
+    """The stream of a degraded chatbot request: the matches, without answer"""
+    try:
+        matches = await find_by_query(reads, q, params)
+    except Exception as e:
+        yield sse_event("error", str(e))
+        return
+    yield sse_event("matches", matches)
+    yield sse_event("degraded", "The chatbot is overloaded, showing matches only.")
+
+
+def request_timeout(request, default):
+    """The seconds of the X-Request-Timeout header, or `default`"""
+    header = request.headers.get("x-request-timeout")
+    if header is None:
+        return default
+    try:
+        timeout = float(header)
+    except ValueError:
+        timeout = 0.0
+    if not timeout > 0:
+        raise HTTPException(
+            status_code=422,
+            detail="X-Request-Timeout must be a positive number of seconds",
+        )
+    return min(timeout, REQUEST_TIMEOUT_MAX)
+
+
+async def wait_for_disconnect(request):
+    while (await request.receive())["type"] != "http.disconnect":
+        pass
+
+
+async def within_deadline(request, endpoint, default_timeout, work):
+    """
+    Runs the `work` coroutine function of a request until its deadline,
+    cancelling it, its queries and its pending embedding and LLM calls when
+    the deadline expires or the client disconnects first
+    """
+    timeout = request_timeout(request, default_timeout)
+    try:
+        return await run_with_deadline(work(), timeout, wait_for_disconnect(request))
+    except DeadlineExceeded:
+        cancelled_requests[(endpoint, "deadline")] += 1
+        raise HTTPException(status_code=504, detail="The request deadline expired.")
+    except ClientDisconnected:
+        cancelled_requests[(endpoint, "disconnect")] += 1
+        # Nobody reads it, but uvicorn logs it as the nginx "client closed".
+        return Response(status_code=499)
+
+
+def deadline_expired():
+    cancelled_requests[("chatbot", "deadline")] += 1
+    return sse_event("error", "The request deadline expired.")
+
+
+async def releasing(events, admission):
+    try:
+        async for event in events:
+            yield event
+    except asyncio.CancelledError:
+        # Starlette cancels the stream when the client disconnects.
+        cancelled_requests[("chatbot", "disconnect")] += 1
+        raise
+    finally:
+        admission.release()
+
+
 @app.get("/search")
-async def do_search(request: Request, q: Union[str, None] = None):
-    return await find_by_query(request.app.state.pool, q)
+async def do_search(
+    request: Request,
+    q: Union[str, None] = None,
+    params: SearchParams = Depends(search_params),
+):
+
+    async def search():
+        async with admitted(search_admission):
+            return await find_by_query(request.app.state.reads, q, params)
+
+    return await within_deadline(request, "search", SEARCH_REQUEST_TIMEOUT, search)
+
+
+class SearchBatch(BaseModel):
+    queries: List[str] = Field(min_length=1, max_length=SEARCH_BATCH_MAX_QUERIES)
+
+
+@app.post("/search/batch")
+async def do_search_batch(
+    request: Request,
+    batch: SearchBatch,
+    params: SearchParams = Depends(search_params),
+):
+    if params.retrieval != "vector":
+        raise HTTPException(
+            status_code=422, detail="Batch search only supports vector retrieval"
+        )
+
+    async def search():
+        async with admitted(search_admission):
+            return await find_by_queries(request.app.state.reads, batch.queries, params)
+
+    return await within_deadline(request, "search", SEARCH_REQUEST_TIMEOUT, search)
 
 
 @app.get("/chatbot")
-async def ask_chatbot(request: Request, q: Union[str, None] = None):
-    return await find_by_chatbot(request.app.state.pool, q)
+async def ask_chatbot(
+    request: Request,
+    q: Union[str, None] = None,
+    params: SearchParams = Depends(search_params),
+):
+
+    async def answer():
+        admission, degraded = await admit_chatbot()
+        try:
+            if degraded:
+                matches = await find_by_query(request.app.state.reads, q, params)
+                return {"answer": None, "matches": matches, "degraded": True}
+            return await find_by_chatbot(
+                request.app.state.pool, request.app.state.reads, q, params
+            )
+        finally:
+            admission.release()
+
+    return await within_deadline(request, "chatbot", CHATBOT_REQUEST_TIMEOUT, answer)
+
+
+@app.get("/chatbot/stream")
+async def stream_chatbot_answer(
+    request: Request,
+    q: Union[str, None] = None,
+    params: SearchParams = Depends(search_params),
+):
+    # The stream runs in a task that inherits the deadline set here.
+    set_deadline(request_timeout(request, CHATBOT_REQUEST_TIMEOUT))
+    admission, degraded = await admit_chatbot()
+    if degraded:
+        events = stream_matches(request.app.state.reads, q, params)
+    else:
+        events = stream_chatbot(
+            request.app.state.pool, request.app.state.reads, q, params
+        )
+    # The background task releases the slot should the client disconnect
+    # before the stream starts.
+    return StreamingResponse(
+        releasing(deadline_events(events, deadline_expired), admission),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+        background=BackgroundTask(admission.release),
+    )
+
+
+@app.get("/stats")
+async def stats(request: Request):
+    return {
+        "startup": request.app.state.startup.stats(),
+        "embedding_cache": embedding_cache.stats(),
+        "embedding_executor": embedding_executor.stats(),
+        "embedding_batcher": embedding_batcher.stats(),
+        "llm_executor": llm_executor.stats(),
+        "search_singleflight": search_flight.stats(),
+        "result_cache": result_cache.stats(),
+        "answer_cache": answer_cache.stats(),
+        "search_snapshot": search_snapshot.stats() if search_snapshot else None,
+        "map_step": map_step_stats,
+        "chatbot_stream": {
+            "time_to_first_byte": stream_ttfb.stats(),
+            "time_to_first_token": stream_ttft.stats(),
+        },
+        "dataset_generation": dataset_generation.value,
+        "iam_token": token_refresher.stats() if token_refresher else None,
+        "read_replicas": request.app.state.reads.stats(),
+        "admission": {
+            "search": search_admission.stats(),
+            "chatbot": chatbot_admission.stats(),
+        },
+        "degraded": degraded_stats,
+        "cancelled_requests": {
+            f"{endpoint}_{reason}": n
+            for (endpoint, reason), n in cancelled_requests.items()
+        },
+    }
+
+
+@app.get("/metrics")
+async def metrics(request: Request):
+    """Stage latencies and pool saturation in the Prometheus text format"""
+    reads = request.app.state.reads
+    pools = {"primary": request.app.state.pool}
+    pools.update((r.name, r.pool) for r in reads.replicas)
+    connections = {}
+    for name, pool in pools.items():
+        size, idle = pool.get_size(), pool.get_idle_size()
+        connections[(("pool", name), ("state", "in_use"))] = size - idle
+        connections[(("pool", name), ("state", "idle"))] = idle
+    body = (
+        prometheus_histogram(
+            "chatbot_api_stage_duration_seconds",
+            "Time spent in each stage of the search and chatbot requests.",
+            {(("stage", stage),): h for stage, h in stage_latency.items()},
+        )
+        + prometheus_histogram(
+            "chatbot_api_stream_first_event_seconds",
+            "Time until the first matches and the first answer token are streamed.",
+            {(("event", "matches"),): stream_ttfb, (("event", "token"),): stream_ttft},
+        )
+        + prometheus_gauge(
+            "chatbot_api_db_pool_connections",
+            "Database pool connections by state.",
+            connections,
+        )
+        + prometheus_gauge(
+            "chatbot_api_db_pool_max_connections",
+            "Maximum size of the database pool.",
+            {(("pool", name),): pool.get_max_size() for name, pool in pools.items()},
+        )
+        + prometheus_gauge(
+            "chatbot_api_db_pool_waiters",
+            "Requests waiting to acquire a database connection.",
+            {(): pool_stats["waiters"]},
+        )
+        + prometheus_gauge(
+            "chatbot_api_db_primary_reads_total",
+            "Searches served by the primary because no read replica was routable.",
+            {(): reads.primary_reads},
+            type="counter",
+        )
+    )
+    controllers = {
+        (("endpoint", c.name),): c for c in (search_admission, chatbot_admission)
+    }
+    body += (
+        prometheus_histogram(
+            "chatbot_api_admission_queue_seconds",
+            "Time requests waited for a slot of their endpoint.",
+            {labels: c.queue_time for labels, c in controllers.items()},
+        )
+        + prometheus_gauge(
+            "chatbot_api_admission_requests",
+            "Requests by endpoint and admission state.",
+            {
+                labels + (("state", state),): getattr(c, state)
+                for labels, c in controllers.items()
+                for state in ("active", "queued")
+            },
+        )
+        + prometheus_gauge(
+            "chatbot_api_admission_shed_total",
+            "Requests shed because the queue was full or their queue time ran out.",
+            {
+                labels + (("reason", reason),): getattr(c, reason)
+                for labels, c in controllers.items()
+                for reason in ("rejected", "timed_out")
+            },
+            type="counter",
+        )
+        + prometheus_gauge(
+            "chatbot_api_requests_cancelled_total",
+            "Requests cancelled by their deadline or by a client disconnect.",
+            {
+                (("endpoint", endpoint), ("reason", reason)): n
+                for (endpoint, reason), n in cancelled_requests.items()
+            },
+            type="counter",
+        )
+        + prometheus_gauge(
+            "chatbot_api_stage_cancelled_total",
+            "Stages of the search and chatbot requests cancelled before completing.",
+            {(("stage", stage),): h.cancelled for stage, h in stage_latency.items()},
+            type="counter",
+        )
+        + prometheus_gauge(
+            "chatbot_api_chatbot_degraded_total",
+            "Chatbot requests answered with the search matches only.",
+            {(): degraded_stats["chatbot"]},
+            type="counter",
+        )
+    )
+    if reads.replicas:
+        replicas = {(("replica", r.name),): r for r in reads.replicas}
+        body += (
+            prometheus_histogram(
+                "chatbot_api_db_replica_read_seconds",
+                "Time searches spent on each read replica, including the pool wait.",
+                {labels: r.latency for labels, r in replicas.items()},
+            )
+            + prometheus_gauge(
+                "chatbot_api_db_replica_outstanding",
+                "Searches in flight on each read replica.",
+                {labels: r.outstanding for labels, r in replicas.items()},
+            )
+            + prometheus_gauge(
+                "chatbot_api_db_replica_ejected",
+                "Whether each read replica is currently ejected.",
+                {labels: int(r.ejected) for labels, r in replicas.items()},
+            )
+            + prometheus_gauge(
+                "chatbot_api_db_replica_failures_total",
+                "Failed searches and health checks of each read replica.",
+                {labels: r.failures for labels, r in replicas.items()},
+                type="counter",
+            )
+            + prometheus_gauge(
+                "chatbot_api_db_replica_ejections_total",
+                "Times each read replica was ejected.",
+                {labels: r.ejections for labels, r in replicas.items()},
+                type="counter",
+            )
+        )
+    if token_refresher is not None:
+        body += (
+            prometheus_histogram(
+                "chatbot_api_iam_token_refresh_seconds",
+                "Time taken to refresh the IAM database token.",
+                {(): token_refresher.latency},
+            )
+            + prometheus_gauge(
+                "chatbot_api_iam_token_refresh_failures_total",
+                "Failed refreshes of the IAM database token.",
+                {(): token_refresher.failures},
+                type="counter",
+            )
+            + prometheus_gauge(
+                "chatbot_api_iam_token_expiry_seconds",
+                "Seconds until the cached IAM database token expires.",
+                {(): min(token_refresher.expires_in(), 3600.0)},
+            )
+        )
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4")
+
+
+def require_admin(x_admin_token: Union[str, None] = Header(None)):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if x_admin_token is None or not secrets.compare_digest(
+        x_admin_token.encode(), ADMIN_TOKEN.encode()
+    ):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+@app.post("/admin/profile", dependencies=[Depends(require_admin)])
+async def profile(
+    seconds: float = Query(10, gt=0, le=PROFILE_MAX_SECONDS),
+    interval: float = Query(0.005, ge=0.001, le=1),
+):
+    """
+    Profiles this worker for `seconds` while it keeps serving requests and
+    returns the sampled stacks in the collapsed flamegraph format
+    """
+    try:
+        stacks = await asyncio.to_thread(profiler.profile, seconds, interval)
+    except ProfilerBusyError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return PlainTextResponse(stacks)
+
+
+@app.get("/admin/tasks", dependencies=[Depends(require_admin)])
+async def tasks():
+    """Dumps the asyncio tasks of this worker and what they are waiting on"""
+    return PlainTextResponse(dump_tasks())
 
 
 @app.get("/")
 async def root(request: Request):
-    async with request.app.state.pool.acquire() as conn:
+    async with acquire(request.app.state.pool) as conn:
         version = await conn.fetch("select version()")
         return version[0]
@@ -0,0 +1,76 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+
+
+class SingleFlight:
+    """Coalesces concurrent calls that share a key into one execution.
+
+    The first caller for a key starts the work as a task; callers arriving
+    while it is in flight await the same task and receive its result or
+    exception. A caller that is cancelled does not cancel the shared work
+    while other callers still wait for it, but the last one to go does.
+
+    The task runs in the context returned by `context`, if given, rather
+    than in a copy of the first caller's, so that context variables of that
+    caller alone, such as its request deadline, do not apply to the others.
+    """
+
+    def __init__(self, context=None):
+        self.context = context
+        self.calls = 0
+        self.coalesced = 0
+        self.abandoned = 0
+        self._inflight = {}
+        self._waiters = {}
+
+    async def do(self, key, func, /, *args, **kwargs):
+        self.calls += 1
+        task = self._inflight.get(key)
+        if task is None:
+            context = self.context() if self.context is not None else None
+            task = asyncio.get_running_loop().create_task(
+                func(*args, **kwargs), context=context
+            )
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        else:
+            self.coalesced += 1
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self._waiters[task] == 1 and not task.done():
+                self.abandoned += 1
+                task.cancel()
+            raise
+        finally:
+            self._waiters[task] -= 1
+            if not self._waiters[task]:
+                del self._waiters[task]
+
+    def _done(self, key, task):
+        self._inflight.pop(key, None)
+        # Mark the exception as retrieved in case every caller went away.
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "abandoned": self.abandoned,
+            "inflight": len(self._inflight),
+        }
@@ -0,0 +1,141 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import json
+import logging
+import os
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotIndex:
+    """An exact in-memory vector search over one exported snapshot.
+
+    A snapshot directory, written by the load-embeddings job, holds:
+
+    - meta.json: the generation, dimensions and counts
+    - embeddings.npy: one unit-length row per chunk, grouped by product
+    - offsets.npy: the index of the first chunk of each product
+    - list_prices.npy: the price of each product
+    - products.json: the id, name, description and price of each product
+
+    The arrays are memory-mapped read-only, so every worker process on a
+    host shares a single copy of their pages.
+    """
+
+    def __init__(self, path: str):
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        with open(os.path.join(path, "products.json")) as f:
+            self.products = json.load(f)
+        self.generation = meta["generation"]
+        self.embeddings = np.load(os.path.join(path, "embeddings.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        self.list_prices = np.load(os.path.join(path, "list_prices.npy"), mmap_mode="r")
+        if not (len(self.products) == len(self.offsets) == len(self.list_prices)):
+            raise Exception(f"Inconsistent search snapshot in {path}")
+
+    def search(self, embedding, min_price, max_price, similarity_threshold, k):
+        """
+        Returns the `k` products most similar to `embedding` by the cosine
+        similarity of their closest chunk, filtered like the SQL search
+        """
+        q = np.asarray(embedding, dtype=np.float32)
+        q = q / np.linalg.norm(q)
+        similarities = np.maximum.reduceat(self.embeddings @ q, self.offsets)
+        candidates = np.flatnonzero(
+            (similarities > similarity_threshold)
+            & (self.list_prices >= min_price)
+            & (self.list_prices <= max_price)
+        )
+        if len(candidates) > k:
+            top = np.argpartition(-similarities[candidates], k - 1)[:k]
+            candidates = candidates[top]
+        candidates = candidates[np.argsort(-similarities[candidates], kind="stable")]
+        return [self.products[i] for i in candidates]
+
+
+class SearchSnapshot:
+    """Keeps the snapshot of the current dataset generation loaded.
+
+    Snapshots live in `directory` as one generation-<N> subdirectory per
+    dataset generation. `load` swaps in a fully loaded index in a single
+    assignment, so concurrent searches see either the old or the new one.
+    A snapshot that is missing or fails to load is retried by `watch` every
+    `retry_interval` seconds; each failure is only logged once.
+    """
+
+    def __init__(self, directory: str, retry_interval: float = 30.0):
+        self.directory = directory
+        self.retry_interval = retry_interval
+        self.index = None
+        self.searches = 0
+        self.fallbacks = 0
+        self.load_failures = 0
+        self._failed = None
+
+    def load(self, generation):
+        path = os.path.join(self.directory, f"generation-{generation}")
+        try:
+            self.index = SnapshotIndex(path)
+        except Exception as e:
+            self.index = None
+            self.load_failures += 1
+            if self._failed == (generation, type(e)):
+                return
+            self._failed = (generation, type(e))
+            if isinstance(e, FileNotFoundError):
+                logger.warning("no search snapshot at %s, searching in Postgres", path)
+            else:
+                logger.exception("failed to load search snapshot %s", path)
+            return
+        self._failed = None
+
+    def refresh(self, generation):
+        """Loads the snapshot of `generation` unless it is loaded already"""
+        index = self.index
+        if index is None or index.generation != generation:
+            self.load(generation)
+
+    async def watch(self, generation):
+        """Keeps retrying the snapshot of the DatasetGeneration `generation`"""
+        while True:
+            await asyncio.sleep(self.retry_interval)
+            if generation.value:
+                self.refresh(generation.value)
+
+    def get(self, generation):
+        """Returns the index of `generation`, if it is loaded"""
+        index = self.index
+        if index is not None and index.generation == generation:
+            self.searches += 1
+            return index
+        self.fallbacks += 1
+        return None
+
+    def stats(self):
+        index = self.index
+        return {
+            "generation": index.generation if index is not None else None,
+            "products": len(index.products) if index is not None else 0,
+            "chunks": len(index.embeddings) if index is not None else 0,
+            "dtype": str(index.embeddings.dtype) if index is not None else None,
+            "searches": self.searches,
+            "fallbacks": self.fallbacks,
+            "load_failures": self.load_failures,
+        }
@@ -0,0 +1,55 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import time
+
+
+class StartupReport:
+    """Records how long each step of the application startup takes.
+
+    Steps that run concurrently overlap, so their durations can add up to
+    more than the total. The CPU time the process used before the startup
+    began is mostly spent importing modules.
+    """
+
+    def __init__(self):
+        self.import_cpu_time = time.process_time()
+        self.started = time.perf_counter()
+        self.steps = {}
+        self.errors = {}
+        self.total = None
+
+    async def timed(self, name, awaitable):
+        start = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.steps[name] = time.perf_counter() - start
+
+    def failed(self, name, error):
+        self.errors[name] = str(error)
+
+    def finish(self):
+        self.total = time.perf_counter() - self.started
+        # One JSON line, so that Cloud Logging parses it as a structured entry.
+        print(json.dumps({"message": "startup report", **self.stats()}), flush=True)
+
+    def stats(self):
+        return {
+            "import_cpu_time": round(self.import_cpu_time, 3),
+            "steps": {name: round(t, 3) for name, t in self.steps.items()},
+            "errors": self.errors,
+            "total": round(self.total, 3) if self.total is not None else None,
+        }
@@ -0,0 +1,312 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Load test the chatbot API without Vertex AI.
+
+Starts the API with uvicorn, using the fake embedding and LLM clients with
+the given latencies, against the database configured by the DB_* environment
+variables (for example a local Postgres with pgvector). The database must be
+loaded with the fake embeddings too, or no query matches any product: pass
+`--seed` to load it first by running the load-embeddings job with
+FAKE_VERTEXAI=true, which needs the job's requirements. Each endpoint is
+then called by `--concurrency` clients until `--requests` requests have
+completed, and the latency percentiles, throughput and error rate per
+endpoint are printed and written to `--output` as JSON. Pass an earlier
+output with `--compare` to see the change.
+
+    DB_HOST=localhost DB_USER=postgres DB_PASSWORD=postgres DB_NAME=postgres \\
+    DB_SSL=disable python benchmark.py --seed --concurrency 16 \\
+      --output after.json --compare before.json
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import aiohttp
+import numpy as np
+
+
+DEFAULT_QUERIES = [
+    "indoor games for a rainy day",
+    "outdoor toys for toddlers",
+    "board game for family night",
+    "rock paper scissors dice game",
+    "remote control car",
+    "stuffed animal unicorn",
+    "building blocks for kids",
+    "puzzle with 1000 pieces",
+    "training wheels for a bike",
+    "science kit for teenagers",
+    "water guns for the pool",
+    "dolls with accessories",
+]
+
+ENDPOINTS = {
+    "search": "/search",
+    "chatbot": "/chatbot",
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--endpoints",
+        default="search,chatbot",
+        help="comma separated endpoints to load, from: " + ", ".join(ENDPOINTS),
+    )
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--requests", type=int, default=200, help="requests measured per endpoint"
+    )
+    parser.add_argument(
+        "--warmup", type=int, default=10, help="unmeasured requests per endpoint"
+    )
+    parser.add_argument(
+        "--queries", help="file with one query per line, instead of built-in ones"
+    )
+    parser.add_argument(
+        "--distinct",
+        action="store_true",
+        help="make every query unique so that no request hits a cache",
+    )
+    parser.add_argument("--embedding-latency", type=float, default=0.05)
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--llm-token-latency", type=float, default=0.0)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers")
+    parser.add_argument(
+        "--url", help="benchmark an already running API instead of starting one"
+    )
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--output", help="file to write the results to as JSON")
+    parser.add_argument("--compare", help="earlier results to compare against")
+    parser.add_argument(
+        "--seed",
+        action="store_true",
+        help="load the database with the load-embeddings job and fake clients first",
+    )
+    return parser.parse_args()
+
+
+def seed_database():
+    """Runs the load-embeddings job with the fake Vertex AI clients"""
+    job = os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "load-embeddings"
+    )
+    subprocess.run(
+        [sys.executable, "main.py"],
+        cwd=job,
+        env=dict(os.environ, FAKE_VERTEXAI="true"),
+        check=True,
+    )
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(args, port):
+    env = dict(
+        os.environ,
+        FAKE_VERTEXAI="true",
+        FAKE_EMBEDDING_LATENCY=str(args.embedding_latency),
+        FAKE_LLM_LATENCY=str(args.llm_latency),
+        FAKE_LLM_TOKEN_LATENCY=str(args.llm_token_latency),
+    )
+    return subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "app.main:app",
+            "--port",
+            str(port),
+            "--workers",
+            str(args.workers),
+            "--log-level",
+            "warning",
+        ],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+    )
+
+
+async def wait_until_ready(session, url, server, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server is not None and server.poll() is not None:
+            raise Exception("The API exited during startup.")
+        try:
+            async with session.get(url + "/") as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise Exception(f"The API at {url} did not become ready.")
+
+
+async def run_endpoint(session, url, path, queries, args, count, offset):
+    """Sends `count` requests from `args.concurrency` concurrent clients"""
+    latencies = []
+    errors = {}
+    next_request = iter(range(count))
+
+    async def client():
+        for i in next_request:
+            q = queries[(offset + i) % len(queries)]
+            if args.distinct:
+                q = f"{q} {offset + i}"
+            start = time.perf_counter()
+            try:
+                async with session.get(url + path, params={"q": q}) as response:
+                    await response.read()
+                    error = None if response.status == 200 else str(response.status)
+            except Exception as e:
+                error = type(e).__name__
+            latencies.append(time.perf_counter() - start)
+            if error is not None:
+                errors[error] = errors.get(error, 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(args.concurrency)])
+    return latencies, errors, time.perf_counter() - start
+
+
+def summarize(latencies, errors, duration):
+    failed = sum(errors.values())
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if latencies else (0, 0, 0)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "error_rate": failed / len(latencies) if latencies else 0.0,
+        "duration": duration,
+        "throughput": len(latencies) / duration if duration else 0.0,
+        "latency": {
+            "mean": float(np.mean(latencies)) if latencies else 0.0,
+            "p50": float(p50),
+            "p95": float(p95),
+            "p99": float(p99),
+            "max": float(max(latencies, default=0.0)),
+        },
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def report(results, baseline=None):
+    print(
+        f"{'endpoint':<10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+        f"{'req/s':>9} {'errors':>7}"
+    )
+    for endpoint, r in results["endpoints"].items():
+        latency = r["latency"]
+        print(
+            f"{endpoint:<10} {latency['p50'] * 1000:9.1f} "
+            f"{latency['p95'] * 1000:9.1f} {latency['p99'] * 1000:9.1f} "
+            f"{r['throughput']:9.1f} {r['error_rate']:7.1%}"
+        )
+        before = (baseline or {}).get("endpoints", {}).get(endpoint)
+        if before:
+            changes = [
+                (name, latency[name], before["latency"][name])
+                for name in ("p50", "p95", "p99")
+            ]
+            changes.append(("req/s", r["throughput"], before["throughput"]))
+            print(
+                f"{'':<10} vs {baseline.get('commit') or 'baseline'}: "
+                + ", ".join(
+                    f"{name} {(now - then) / then:+.1%}"
+                    for name, now, then in changes
+                    if then
+                )
+            )
+
+
+async def main():
+    args = parse_args()
+    endpoints = [e.strip() for e in args.endpoints.split(",") if e.strip()]
+    for endpoint in endpoints:
+        if endpoint not in ENDPOINTS:
+            raise SystemExit(f"Unknown endpoint: {endpoint}")
+    queries = DEFAULT_QUERIES
+    if args.queries:
+        with open(args.queries) as f:
+            queries = [line.strip() for line in f if line.strip()]
+
+    if args.seed:
+        seed_database()
+
+    server = None
+    url = args.url
+    if url is None:
+        port = free_port()
+        url = f"http://127.0.0.1:{port}"
+        server = start_server(args, port)
+
+    results = {
+        "commit": git_commit(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "config": vars(args),
+        "endpoints": {},
+    }
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    try:
+        async with aiohttp.ClientSession(
+            timeout=timeout, connector=connector
+        ) as session:
+            await wait_until_ready(session, url, server)
+            for endpoint in endpoints:
+                path = ENDPOINTS[endpoint]
+                await run_endpoint(session, url, path, queries, args, args.warmup, 0)
+                latencies, errors, duration = await run_endpoint(
+                    session, url, path, queries, args, args.requests, args.warmup
+                )
+                results["endpoints"][endpoint] = summarize(latencies, errors, duration)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,65 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+
+import pytest
+
+from app.batcher import MicroBatcher
+
+
+def submit_all(func, items):
+    batcher = MicroBatcher(func, 0.01, 100)
+
+    async def run():
+        # Callers left waiting fail the test instead of hanging it.
+        return await asyncio.wait_for(
+            asyncio.gather(
+                *[batcher.submit(item) for item in items], return_exceptions=True
+            ),
+            1,
+        )
+
+    return asyncio.run(run())
+
+
+def test_callers_get_their_own_results():
+    async def double(items):
+        return [2 * item for item in items]
+
+    assert submit_all(double, [1, 2, 3, 2]) == [2, 4, 6, 4]
+
+
+async def too_few(items):
+    return items[:-1]
+
+
+async def too_many(items):
+    return items + items
+
+
+@pytest.mark.parametrize("func", [too_few, too_many])
+def test_wrong_number_of_results_fails_every_caller(func):
+    results = submit_all(func, [1, 2, 3])
+    assert all(isinstance(r, Exception) for r in results), results
+
+
+def test_cancelled_batch_fails_every_caller():
+    async def cancelled(items):
+        raise asyncio.CancelledError()
+
+    results = submit_all(cancelled, [1, 2, 3])
+    assert all(
+        isinstance(r, Exception) and "cancelled" in str(r) for r in results
+    ), results
@@ -0,0 +1,131 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import time
+
+from app import main
+from app.deadline import DeadlineExceeded, run_with_deadline, set_deadline
+from app.fakes import FakeEmbeddings
+from app.replicas import ReadRouter
+
+
+EMBEDDING_LATENCY = 0.25
+QUERY_LATENCY = 0.3
+
+ROWS = [
+    {
+        "candidates": 100,
+        "max_distance": 0.5,
+        "product_id": f"product-{i}",
+        "product_name": f"Toy {i}",
+        "list_price": 30.0,
+        "description": "A toy.",
+    }
+    for i in range(25)
+]
+
+
+class StubConnection:
+    async def fetch(self, sql, *args, timeout=None):
+        return ROWS
+
+
+class SlowConnection:
+    async def fetch(self, sql, *args, timeout=None):
+        await asyncio.wait_for(asyncio.sleep(QUERY_LATENCY), timeout)
+        return ROWS
+
+
+class StubPool:
+    def __init__(self, connection=StubConnection):
+        self.connection = connection
+
+    async def acquire(self, timeout=None):
+        return self.connection()
+
+    async def release(self, conn):
+        pass
+
+
+def test_concurrent_searches_overlap(monkeypatch):
+    monkeypatch.setattr(
+        main, "embeddings_service", FakeEmbeddings(latency=EMBEDDING_LATENCY)
+    )
+    # Embed every query on its own, so the searches can only overlap if the
+    # blocking embedding calls run off the event loop.
+    monkeypatch.setattr(main.embedding_batcher, "max_size", 1)
+    reads = ReadRouter(StubPool(), [], main.dataset_generation)
+    queries = [f"concurrent search {i}" for i in range(4)]
+
+    async def search_all():
+        return await asyncio.gather(*[main.find_by_query(reads, q) for q in queries])
+
+    start = time.perf_counter()
+    results = asyncio.run(search_all())
+    elapsed = time.perf_counter() - start
+
+    assert [len(matches) for matches in results] == [25] * len(queries)
+    assert elapsed < 2 * EMBEDDING_LATENCY
+
+
+def test_coalesced_searches_keep_their_own_deadlines(monkeypatch):
+    monkeypatch.setattr(main, "embeddings_service", FakeEmbeddings())
+    reads = ReadRouter(
+        StubPool(), [("replica", StubPool(SlowConnection))], main.dataset_generation
+    )
+    replica = reads.replicas[0]
+    replica.generation = main.dataset_generation.value
+
+    async def never():
+        await asyncio.Event().wait()
+
+    async def search(timeout):
+        return await run_with_deadline(
+            main.find_by_query(reads, "coalesced search"), timeout, never()
+        )
+
+    async def search_both():
+        return await asyncio.gather(
+            search(QUERY_LATENCY / 3),
+            search(10 * QUERY_LATENCY),
+            return_exceptions=True,
+        )
+
+    short, long = asyncio.run(search_both())
+
+    assert isinstance(short, DeadlineExceeded)
+    assert len(long) == 25
+    assert replica.failures == 0
+
+
+def test_deadline_timeouts_are_not_replica_failures():
+    reads = ReadRouter(StubPool(), [("replica", StubPool())], main.dataset_generation)
+    replica = reads.replicas[0]
+    replica.generation = main.dataset_generation.value
+
+    async def read(timeout, deadline=None):
+        if deadline is not None:
+            set_deadline(deadline)
+        try:
+            async with reads.read():
+                await asyncio.wait_for(asyncio.sleep(1), timeout)
+        except TimeoutError:
+            pass
+
+    asyncio.run(read(0.01, deadline=0.01))
+    assert replica.failures == 0
+    asyncio.run(read(0.01, deadline=10))
+    asyncio.run(read(0.01))
+    assert replica.failures == 2
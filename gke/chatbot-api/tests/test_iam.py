@@ -0,0 +1,70 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import time
+
+from app.fakes import FakeCredentials
+from app.iam import TokenRefresher
+
+
+def refresher(credentials, **kwargs):
+    return TokenRefresher(credentials, lambda: None, **kwargs)
+
+
+def test_failed_refreshes_are_retried():
+    credentials = FakeCredentials(failures=2)
+    tokens = refresher(credentials, retry_delay=0.01)
+
+    async def run_until_refreshed():
+        task = asyncio.create_task(tokens.run())
+        try:
+            while not tokens.refreshes:
+                await asyncio.sleep(0.01)
+        finally:
+            task.cancel()
+        return await tokens.token()
+
+    assert asyncio.run(run_until_refreshed()) == "fake-token-1"
+    assert tokens.failures == 2
+
+
+def test_expired_token_is_refreshed_once_for_concurrent_callers():
+    credentials = FakeCredentials(lifetime=0, latency=0.1)
+    tokens = refresher(credentials)
+
+    async def get_tokens():
+        await tokens.refresh()
+        credentials.lifetime = 3600.0
+        return await asyncio.gather(*[tokens.token() for _ in range(5)])
+
+    assert asyncio.run(get_tokens()) == ["fake-token-2"] * 5
+    assert credentials.refreshes == 2
+
+
+def test_token_is_cached():
+    credentials = FakeCredentials()
+    tokens = refresher(credentials)
+
+    async def get_token():
+        await tokens.refresh()
+        credentials.latency = 1.0
+        start = time.perf_counter()
+        token = await tokens.token()
+        return token, time.perf_counter() - start
+
+    token, elapsed = asyncio.run(get_token())
+    assert token == "fake-token-1"
+    assert elapsed < 0.1
+    assert credentials.refreshes == 1
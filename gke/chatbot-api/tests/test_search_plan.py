@@ -0,0 +1,84 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Checks that the vector searches are served by an index.
+
+Needs a Postgres with pgvector loaded by the load-embeddings job, configured
+with the same DB_* environment variables as the API, for example:
+
+    DB_HOST=localhost DB_USER=postgres DB_PASSWORD=postgres DB_NAME=postgres \\
+    DB_SSL=disable python -m pytest tests/test_search_plan.py
+"""
+
+import asyncio
+
+import asyncpg
+import pytest
+
+from app import main
+from app.fakes import FakeEmbeddings
+
+
+pytestmark = pytest.mark.skipif(
+    not main.DB_HOST, reason="no database configured in DB_HOST"
+)
+
+
+async def explain(mode, sql, query_embedding):
+    conn = await asyncpg.connect(
+        host=main.DB_HOST,
+        user=main.DB_USER,
+        password=main.DB_PASSWORD,
+        database=main.DB_NAME,
+        ssl=main.DB_SSL,
+    )
+    try:
+        await main.init_connection(conn)
+        if not await conn.fetchval("SELECT to_regclass('product_embeddings')"):
+            pytest.skip("the load-embeddings job has not loaded the database")
+        params = main.SearchParams(mode=mode)
+        num_candidates, ef_search = main.search_settings(params)
+        async with conn.transaction(readonly=True):
+            await conn.execute(f"SET LOCAL hnsw.ef_search = {ef_search}")
+            rows = await conn.fetch(
+                "EXPLAIN " + sql,
+                query_embedding,
+                params.similarity_threshold,
+                num_candidates,
+                params.min_price,
+                params.max_price,
+                params.num_matches,
+            )
+    finally:
+        await conn.close()
+    return "\n".join(r[0] for r in rows)
+
+
+@pytest.mark.parametrize("mode", list(main.SEARCH_MODES))
+def test_search_uses_vector_index(mode):
+    query_embedding = FakeEmbeddings().embed_query("toys for kids")
+    plan = asyncio.run(explain(mode, main.SEARCH_PRODUCTS_SQL, query_embedding))
+    scans = [line for line in plan.splitlines() if "product_embeddings" in line]
+    assert scans, plan
+    assert all("Index Scan" in line for line in scans), plan
+
+
+def test_batch_search_uses_vector_index():
+    query_embedding = FakeEmbeddings().embed_query("toys for kids")
+    plan = asyncio.run(
+        explain("balanced", main.BATCH_SEARCH_PRODUCTS_SQL, [str(query_embedding)])
+    )
+    scans = [line for line in plan.splitlines() if "product_embeddings" in line]
+    assert scans, plan
+    assert all("Index Scan" in line for line in scans), plan
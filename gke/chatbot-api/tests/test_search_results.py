@@ -0,0 +1,84 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Checks that searches return k products when that many match.
+
+Needs a Postgres with pgvector loaded by the load-embeddings job, like
+test_search_plan.py.
+"""
+
+import asyncio
+
+import pytest
+
+from app import main
+from app.fakes import FakeEmbeddings
+from app.replicas import ReadRouter
+
+
+pytestmark = pytest.mark.skipif(
+    not main.DB_HOST, reason="no database configured in DB_HOST"
+)
+
+# The products whose nearest chunk passes the threshold, in the price range.
+MATCHING_PRODUCTS_SQL = """
+    SELECT count(*)
+    FROM (
+      SELECT product_id, min(embedding <=> $1) AS distance
+      FROM product_embeddings
+      GROUP BY product_id
+    ) c
+    JOIN products p USING (product_id)
+    WHERE 1 - c.distance > $2
+    AND p.list_price >= $3 AND p.list_price <= $4
+"""
+
+
+async def search(q, params):
+    qe = FakeEmbeddings().embed_query(q)
+    pool = await main.create_pool(main.DB_HOST, min_size=1)
+    try:
+        async with pool.acquire() as conn:
+            if not await conn.fetchval("SELECT to_regclass('product_embeddings')"):
+                pytest.skip("the load-embeddings job has not loaded the database")
+            matching = await conn.fetchval(
+                MATCHING_PRODUCTS_SQL,
+                qe,
+                params.similarity_threshold,
+                params.min_price,
+                params.max_price,
+            )
+        reads = ReadRouter(pool, [], main.dataset_generation)
+        results = await main.search_products_in_db(reads, q, qe, params)
+    finally:
+        await pool.close()
+    return matching, results
+
+
+@pytest.mark.parametrize("mode", list(main.SEARCH_MODES))
+@pytest.mark.parametrize("retrieval", ["vector", "hybrid"])
+@pytest.mark.parametrize("min_price,max_price", [(25, 100), (40, 60)])
+def test_search_returns_k_matches(mode, retrieval, min_price, max_price):
+    params = main.SearchParams(
+        min_price=min_price,
+        max_price=max_price,
+        num_matches=10,
+        mode=mode,
+        retrieval=retrieval,
+    )
+    matching, results = asyncio.run(search("toys for kids", params))
+    if matching < params.num_matches:
+        pytest.skip(f"only {matching} products match in the database")
+    assert len(results) == params.num_matches
+    assert all(min_price <= r["list_price"] <= max_price for r in results)
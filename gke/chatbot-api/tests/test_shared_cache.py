@@ -0,0 +1,55 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from decimal import Decimal
+import os
+
+import pytest
+
+from app.shared_cache import decode_floats, encode_floats, SharedCache
+
+
+def test_values_round_trip(tmp_path):
+    directory = tmp_path / "cache"
+    embeddings = SharedCache(
+        str(directory / "embeddings.cache"), 16, 4096, 0, encode_floats, decode_floats
+    )
+    results = SharedCache(str(directory / "results.cache"), 16, 4096)
+    match = {"product_id": "p1", "product_name": "Toy", "list_price": Decimal("9.99")}
+
+    embeddings.put(("model", "toy"), [0.5, -0.25, 1.0])
+    results.put((1, ("toy", "fast")), [match])
+
+    assert embeddings.get(("model", "toy")) == [0.5, -0.25, 1.0]
+    assert results.get((1, ("toy", "fast"))) == [match]
+    assert os.stat(directory).st_mode & 0o777 == 0o700
+
+
+def test_files_others_can_access_are_refused(tmp_path):
+    path = tmp_path / "results.cache"
+    path.touch(0o666)
+    path.chmod(0o666)
+
+    with pytest.raises(Exception, match="only it can access"):
+        SharedCache(str(path), 16, 4096)
+
+
+def test_symlinks_are_not_followed(tmp_path):
+    target = tmp_path / "target"
+    target.touch(0o600)
+    (tmp_path / "results.cache").symlink_to(target)
+
+    with pytest.raises(OSError):
+        SharedCache(str(tmp_path / "results.cache"), 16, 4096)
+    assert target.stat().st_size == 0
@@ -0,0 +1,117 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import time
+
+from app.metrics import Histogram
+
+
+# Batch sizes rather than latencies.
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+class MicroBatcher:
+    """Collects items submitted concurrently into batches for one call.
+
+    The first item of a batch opens a window of `window` seconds. The batch
+    is flushed when the window closes or as soon as it holds `max_size`
+    items, whichever comes first. `func` is an async callable taking a list
+    of distinct items and returning one result per item; every caller gets
+    the result for its own item, or the exception raised by `func`. Callers
+    get an exception too when `func` returns another number of results or
+    the batch is cancelled.
+    """
+
+    def __init__(self, func, window: float, max_size: int):
+        self.func = func
+        self.window = window
+        self.max_size = max_size
+        self.batches = 0
+        self.items = 0
+        self.full_batches = 0
+        self.batch_size = Histogram(BATCH_SIZE_BUCKETS)
+        self.wait_time = Histogram()
+        self._pending = {}
+        self._opened_at = 0.0
+        self._timer = None
+        self._flushes = set()
+
+    async def submit(self, item):
+        future = self._pending.get(item)
+        if future is None:
+            if not self._pending:
+                self._opened_at = time.perf_counter()
+                self._timer = asyncio.get_running_loop().call_later(
+                    max(self.window, 0), self._flush
+                )
+            future = asyncio.get_running_loop().create_future()
+            self._pending[item] = future
+            if len(self._pending) >= self.max_size:
+                self.full_batches += 1
+                self._flush()
+        self.items += 1
+        # A caller giving up must not cancel the result other callers share.
+        return await asyncio.shield(future)
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        self.batches += 1
+        self.batch_size.observe(len(pending))
+        self.wait_time.observe(time.perf_counter() - self._opened_at)
+        task = asyncio.ensure_future(self._run(pending))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _run(self, pending):
+        try:
+            results = await self.func(list(pending))
+            if len(results) != len(pending):
+                raise Exception(
+                    f"Got {len(results)} results for a batch of {len(pending)} items."
+                )
+        except Exception as e:
+            self._fail(pending, e)
+            return
+        except BaseException:
+            # Cancelled, e.g. on shutdown: its callers must not wait forever.
+            self._fail(pending, Exception("The batch was cancelled."))
+            raise
+        for future, result in zip(pending.values(), results):
+            if not future.done():
+                future.set_result(result)
+
+    @staticmethod
+    def _fail(pending, e):
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(e)
+            # Callers that gave up would otherwise log it as unretrieved.
+            future.exception()
+
+    def stats(self):
+        return {
+            "window": self.window,
+            "max_size": self.max_size,
+            "batches": self.batches,
+            "items": self.items,
+            "full_batches": self.full_batches,
+            "batch_size": self.batch_size.stats(),
+            "wait_time": self.wait_time.stats(),
+        }
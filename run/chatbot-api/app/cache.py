@@ -0,0 +1,175 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import OrderedDict
+import itertools
+import time
+
+import numpy as np
+
+
+def normalize_query(q: str) -> str:
+    """Normalizes query text so trivially different queries share an entry"""
+    return " ".join(q.lower().split())
+
+
+class LRUCache:
+    """A bounded in-process cache with least-recently-used and TTL eviction.
+
+    A `ttl` of zero or less keeps entries until they are pushed out by size.
+    """
+
+    def __init__(self, maxsize: int, ttl: float = 0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        value, expires_at = entry
+        if expires_at and expires_at < time.monotonic():
+            del self._entries[key]
+            self.evictions += 1
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl > 0 else 0
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class SemanticCache:
+    """Caches answers by query embedding rather than by exact query text.
+
+    A lookup hits when a stored query embedding lies within `max_distance`
+    cosine distance of the new one, was stored under the same dataset
+    generation and has the same `scope` (for example the search parameters
+    the answer was produced with). When full, the least recently used entry
+    is replaced.
+    """
+
+    def __init__(self, capacity: int, max_distance: float):
+        self.capacity = capacity
+        self.max_distance = max_distance
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._vectors = None
+        self._answers = []
+        self._scopes = []
+        self._last_used = np.zeros(max(capacity, 0), dtype=np.int64)
+        self._clock = itertools.count(1)
+
+    def __len__(self):
+        return len(self._answers)
+
+    @staticmethod
+    def _unit(embedding):
+        v = np.asarray(embedding, dtype=np.float32)
+        return v / np.linalg.norm(v)
+
+    def get(self, embedding, generation, scope=None):
+        if generation != self.generation or not self._answers:
+            self.misses += 1
+            return None
+
+        n = len(self._answers)
+        similarities = self._vectors[:n] @ self._unit(embedding)
+        candidates = np.flatnonzero(similarities >= 1 - self.max_distance)
+        for i in candidates[np.argsort(-similarities[candidates])]:
+            if self._scopes[i] == scope:
+                self._last_used[i] = next(self._clock)
+                self.hits += 1
+                return self._answers[i]
+
+        self.misses += 1
+        return None
+
+    def put(self, embedding, answer, generation, scope=None):
+        if self.capacity <= 0:
+            return
+        if generation != self.generation:
+            if self.generation is not None and generation < self.generation:
+                # Computed against a dataset that has since been replaced.
+                return
+            self.clear()
+            self.generation = generation
+
+        v = self._unit(embedding)
+        if self._vectors is None:
+            self._vectors = np.zeros((self.capacity, v.shape[0]), dtype=np.float32)
+
+        if len(self._answers) < self.capacity:
+            i = len(self._answers)
+            self._answers.append(answer)
+            self._scopes.append(scope)
+        else:
+            i = int(np.argmin(self._last_used))
+            self._answers[i] = answer
+            self._scopes[i] = scope
+            self.evictions += 1
+        self._vectors[i] = v
+        self._last_used[i] = next(self._clock)
+
+    def clear(self):
+        self._answers = []
+        self._scopes = []
+        self._last_used[:] = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._answers),
+            "capacity": self.capacity,
+            "max_distance": self.max_distance,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,120 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import contextvars
+import time
+
+
+# The monotonic time by which the current request must be answered.
+_deadline = contextvars.ContextVar("deadline", default=None)
+# Timers may fire this much before the deadline they were set for.
+DEADLINE_SLACK = 0.01
+# The SQLSTATE of a query cancelled by statement_timeout.
+QUERY_CANCELED = "57014"
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+def remaining(default=None):
+    """Seconds left until the deadline of the current request, if it has one"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return default
+    return max(deadline - time.monotonic(), 0.0)
+
+
+def without_deadline():
+    """Returns a copy of the current context in which no deadline is set"""
+    context = contextvars.copy_context()
+    context.run(_deadline.set, None)
+    return context
+
+
+def caused_by_deadline(e: BaseException) -> bool:
+    """
+    Whether `e` is a timeout of the current request's own deadline, i.e. a
+    timeout or a statement_timeout that expired with the deadline
+    """
+    timed_out = isinstance(e, asyncio.TimeoutError) or (
+        getattr(e, "sqlstate", None) == QUERY_CANCELED
+    )
+    return timed_out and remaining(float("inf")) <= DEADLINE_SLACK
+
+
+def set_deadline(timeout: float):
+    """Sets the deadline of the current task to `timeout` seconds from now"""
+    _deadline.set(time.monotonic() + timeout)
+
+
+async def run_with_deadline(coro, timeout: float, disconnected):
+    """
+    Runs `coro` in a task whose `remaining` time starts at `timeout`
+
+    The task is cancelled when the timeout expires, raising DeadlineExceeded,
+    or when the `disconnected` awaitable completes first, raising
+    ClientDisconnected. Either is only raised once the task has finished
+    cleaning up, e.g. once asyncpg cancelled its query on the server.
+    """
+    token = _deadline.set(time.monotonic() + timeout)
+    try:
+        # The task runs in a copy of the current context, deadline included.
+        task = asyncio.ensure_future(coro)
+    finally:
+        _deadline.reset(token)
+    watcher = asyncio.ensure_future(disconnected)
+    try:
+        done, _ = await asyncio.wait(
+            {task, watcher}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+        )
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    finally:
+        watcher.cancel()
+    if task in done:
+        return task.result()
+    task.cancel()
+    await asyncio.wait({task})
+    if watcher in done:
+        raise ClientDisconnected()
+    raise DeadlineExceeded()
+
+
+async def deadline_events(events, on_expired):
+    """
+    Iterates an async generator of streamed events until the deadline
+
+    Each event is awaited with the time remaining, so that the generator
+    is cancelled where it waits once the deadline expires. Then the event
+    returned by `on_expired()` is sent last.
+    """
+    try:
+        while True:
+            try:
+                event = await asyncio.wait_for(anext(events), remaining())
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError:
+                yield on_expired()
+                return
+            yield event
+    finally:
+        await events.aclose()
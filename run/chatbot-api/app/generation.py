@@ -0,0 +1,66 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import logging
+
+import asyncpg
+
+
+logger = logging.getLogger(__name__)
+
+
+class DatasetGeneration:
+    """Tracks the dataset generation marker written by the load-embeddings job.
+
+    The marker is polled in the background so that request handlers can read
+    the current generation without a database round trip. Callbacks
+    registered with `on_change` run whenever a new generation is observed.
+    """
+
+    def __init__(self, name: str, interval: float):
+        self.name = name
+        self.interval = interval
+        self.value = 0
+        self._callbacks = []
+
+    def on_change(self, callback):
+        self._callbacks.append(callback)
+
+    async def read(self, pool) -> int:
+        """Reads the generation recorded in the database of `pool`"""
+        try:
+            generation = await pool.fetchval(
+                "SELECT generation FROM dataset_metadata WHERE name = $1",
+                self.name,
+            )
+        except asyncpg.UndefinedTableError:
+            # The load-embeddings job has not recorded a generation yet.
+            generation = None
+        return generation or 0
+
+    async def refresh(self, pool):
+        generation = await self.read(pool)
+        if generation != self.value:
+            self.value = generation
+            for callback in self._callbacks:
+                callback(generation)
+
+    async def watch(self, pool):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.refresh(pool)
+            except Exception:
+                logger.exception("failed to refresh dataset generation")
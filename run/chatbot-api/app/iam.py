@@ -0,0 +1,120 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import datetime
+import logging
+import time
+
+from app.metrics import Histogram
+
+
+logger = logging.getLogger(__name__)
+
+# The longest the refresher sleeps, e.g. for credentials without an expiry.
+MAX_SLEEP = 3600.0
+
+
+class TokenRefresher:
+    """Keeps the IAM access token used as database password fresh.
+
+    `credentials` is a google.auth credentials object, or anything with the
+    same `token`, `expiry` (naive UTC) and `refresh(request)` members, and
+    `request_factory` creates the transport request passed to `refresh`.
+
+    `run` refreshes the token on a worker thread `margin` seconds before it
+    expires, so `token` returns the cached token without blocking the event
+    loop. After a failed refresh it retries after `retry_delay` seconds,
+    doubling up to `max_retry_delay`, while the current token remains in use
+    until it expires. Only once it has expired does `token` wait for a
+    refresh itself.
+    """
+
+    def __init__(
+        self,
+        credentials,
+        request_factory,
+        margin: float = 300.0,
+        retry_delay: float = 1.0,
+        max_retry_delay: float = 60.0,
+    ):
+        self.credentials = credentials
+        self.request_factory = request_factory
+        self.margin = margin
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.refreshes = 0
+        self.failures = 0
+        self.latency = Histogram()
+        self._token = None
+        self._expiry = None
+        self._lock = asyncio.Lock()
+
+    def expires_in(self) -> float:
+        """Seconds until the cached token expires"""
+        if self._token is None:
+            return 0.0
+        if self._expiry is None:
+            return float("inf")
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        return (self._expiry - now).total_seconds()
+
+    async def refresh(self, only_if_expired=False):
+        async with self._lock:
+            # Callers that waited for the lock may find it already refreshed.
+            if only_if_expired and self.expires_in() > 0:
+                return
+            start = time.perf_counter()
+            try:
+                await asyncio.to_thread(
+                    self.credentials.refresh, self.request_factory()
+                )
+            except Exception:
+                self.failures += 1
+                raise
+            finally:
+                self.latency.observe(time.perf_counter() - start)
+            self.refreshes += 1
+            self._token = self.credentials.token
+            self._expiry = self.credentials.expiry
+
+    async def token(self) -> str:
+        if self.expires_in() <= 0:
+            await self.refresh(only_if_expired=True)
+        return self._token
+
+    async def run(self):
+        failures = 0
+        while True:
+            if failures:
+                delay = self.retry_delay * 2 ** (failures - 1)
+                delay = min(delay, self.max_retry_delay)
+            else:
+                delay = self.expires_in() - self.margin
+                delay = min(max(delay, self.retry_delay), MAX_SLEEP)
+            await asyncio.sleep(delay)
+            try:
+                await self.refresh()
+                failures = 0
+            except Exception:
+                failures += 1
+                logger.exception("failed to refresh the IAM database token")
+
+    def stats(self):
+        return {
+            "refreshes": self.refreshes,
+            "failures": self.failures,
+            "expires_in": round(min(self.expires_in(), MAX_SLEEP), 1),
+            "refresh_latency": self.latency.stats(),
+        }
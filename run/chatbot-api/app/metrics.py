@@ -0,0 +1,129 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import bisect
+import time
+
+# Latency buckets in seconds, from cache hits up to slow LLM answers.
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+
+
+class Histogram:
+    """A fixed-bucket histogram cheap enough to update on every request"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        # Observations of work that was cancelled before it completed.
+        self.cancelled = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def stats(self):
+        cumulative = 0
+        buckets = {}
+        for le, n in zip(self.buckets, self.counts):
+            cumulative += n
+            buckets[str(le)] = cumulative
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "buckets": buckets,
+        }
+
+
+class Timer:
+    """
+    Observes the seconds spent in a `with` block into a histogram, counting
+    blocks left by cancellation as cancelled
+    """
+
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.start)
+        if exc_type is asyncio.CancelledError:
+            self.histogram.cancelled += 1
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def prometheus_histogram(name: str, help: str, histograms: dict) -> str:
+    """
+    Renders histograms in the Prometheus text exposition format
+
+    `histograms` maps a tuple of (label, value) pairs to each histogram.
+    """
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} histogram"]
+    for labels, histogram in histograms.items():
+        labels = dict(labels)
+        cumulative = 0
+        for le, n in zip(histogram.buckets, histogram.counts):
+            cumulative += n
+            lines.append(f"{name}_bucket{_labels({**labels, 'le': le})} {cumulative}")
+        lines.append(
+            f"{name}_bucket{_labels({**labels, 'le': '+Inf'})} {histogram.count}"
+        )
+        lines.append(f"{name}_sum{_labels(labels)} {histogram.sum}")
+        lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+    return "\n".join(lines) + "\n"
+
+
+def prometheus_gauge(name: str, help: str, values: dict, type="gauge") -> str:
+    """
+    Renders gauges, or counters with `type="counter"`, in the Prometheus
+    text exposition format
+
+    `values` maps a tuple of (label, value) pairs to each value.
+    """
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {type}"]
+    for labels, value in values.items():
+        lines.append(f"{name}{_labels(dict(labels))} {value}")
+    return "\n".join(lines) + "\n"
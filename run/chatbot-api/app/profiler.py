@@ -0,0 +1,127 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from collections import Counter
+import os
+import sys
+import threading
+import time
+
+
+class ProfilerBusyError(Exception):
+    pass
+
+
+def _filename(path: str) -> str:
+    # Keep package-relative paths short, e.g. asyncpg/pool.py.
+    marker = os.sep + "site-packages" + os.sep
+    if marker in path:
+        return path.split(marker, 1)[1]
+    return os.path.join(*path.split(os.sep)[-2:])
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_qualname} ({_filename(code.co_filename)}:{frame.f_lineno})"
+
+
+class SamplingProfiler:
+    """A statistical profiler of all the threads of the process.
+
+    While a profile runs, a thread samples the stack of every other thread
+    every `interval` seconds. Nothing is hooked into the interpreter, so
+    there is no overhead at all between profiles. Only one profile runs at
+    a time.
+    """
+
+    def __init__(self):
+        self.profiles = 0
+        self._lock = threading.Lock()
+
+    @property
+    def active(self) -> bool:
+        return self._lock.locked()
+
+    def profile(self, seconds: float, interval: float) -> str:
+        """
+        Samples for `seconds` and returns the stacks in the collapsed format
+        read by flamegraph.pl and speedscope: one line per distinct stack,
+        with the thread name as root frame, followed by its sample count.
+        """
+        if not self._lock.acquire(blocking=False):
+            raise ProfilerBusyError("A profile is already running.")
+        try:
+            self.profiles += 1
+            me = threading.get_ident()
+            counts = Counter()
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                names = {t.ident: t.name for t in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        stack.append(_frame_label(frame))
+                        frame = frame.f_back
+                    stack.append(names.get(ident, str(ident)))
+                    counts[";".join(reversed(stack))] += 1
+                time.sleep(interval)
+        finally:
+            self._lock.release()
+        return "".join(f"{stack} {n}\n" for stack, n in counts.most_common())
+
+    def stats(self):
+        return {"active": self.active, "profiles": self.profiles}
+
+
+def _await_chain(awaitable):
+    """Yields the frames of a coroutine and of what it awaits, in turn"""
+    while awaitable is not None:
+        frame = None
+        for attr in ("cr_frame", "gi_frame", "ag_frame"):
+            frame = frame or getattr(awaitable, attr, None)
+        if frame is None:
+            return
+        yield frame
+        awaitable = (
+            getattr(awaitable, "cr_await", None)
+            or getattr(awaitable, "gi_yieldfrom", None)
+            or getattr(awaitable, "ag_await", None)
+        )
+
+
+def dump_tasks() -> str:
+    """
+    Describes every asyncio task of the running loop: its coroutine, the
+    chain of coroutines it is suspended in, innermost last, and the future
+    it is waiting on
+    """
+    lines = []
+    tasks = sorted(asyncio.all_tasks(), key=lambda t: t.get_name())
+    current = asyncio.current_task()
+    for task in tasks:
+        state = "running" if task is current else "pending"
+        if task.done():
+            state = "done"
+        lines.append(f"{task.get_name()} [{state}] {task.get_coro()!r}")
+        for frame in _await_chain(task.get_coro()):
+            lines.append(f"    {_frame_label(frame)}")
+        # The future a suspended task waits on is only kept privately.
+        waiter = getattr(task, "_fut_waiter", None)
+        if waiter is not None:
+            lines.append(f"    waiting on {waiter!r}"[:500])
+        lines.append("")
+    return f"{len(tasks)} tasks\n\n" + "\n".join(lines)
@@ -0,0 +1,212 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from contextlib import asynccontextmanager
+import logging
+import random
+import time
+
+from app.deadline import caused_by_deadline
+from app.metrics import Histogram
+
+
+logger = logging.getLogger(__name__)
+
+# Weight of the latest read in the moving average of a replica's latency.
+LATENCY_EWMA_WEIGHT = 0.1
+
+
+def parse_hosts(hosts: str):
+    """
+    Parses a comma separated list of `host` or `host:port` into (host, port)
+    pairs. Hosts may be Unix socket directories, e.g. /cloudsql/instance.
+    """
+    parsed = []
+    for host in hosts.split(","):
+        host = host.strip()
+        if not host:
+            continue
+        name, _, port = host.rpartition(":")
+        if name and port.isdigit():
+            parsed.append((name, int(port)))
+        else:
+            parsed.append((host, None))
+    return parsed
+
+
+class Replica:
+    def __init__(self, name: str, pool):
+        self.name = name
+        self.pool = pool
+        self.outstanding = 0
+        self.reads = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = None
+        self.latency = Histogram()
+        self.ewma = None
+        # The dataset generation it has replicated, unknown until checked.
+        self.generation = None
+
+    @property
+    def ejected(self) -> bool:
+        return self.ejected_until is not None
+
+    def stats(self):
+        return {
+            "outstanding": self.outstanding,
+            "reads": self.reads,
+            "failures": self.failures,
+            "ejected": self.ejected,
+            "ejections": self.ejections,
+            "latency_ewma": self.ewma,
+            "generation": self.generation,
+        }
+
+
+class ReadRouter:
+    """Routes read-only queries over a pool per read replica.
+
+    Each read goes to the routable replica with the fewest reads in flight,
+    ties broken at random. A replica is routable once a health check has
+    seen it replicate the current dataset `generation`, so that no search
+    result of an older dataset is cached under the new generation.
+
+    A replica is ejected after `max_failures` consecutive failed reads or
+    health checks, or when the moving average of its read latency exceeds
+    `slow_threshold` seconds while another replica is routable. It is
+    readmitted by the first successful health check `eject_seconds` after
+    its ejection. Reads go to the `primary` pool when no replica is
+    routable.
+    """
+
+    def __init__(
+        self,
+        primary,
+        replicas,
+        generation,
+        max_failures: int = 3,
+        slow_threshold: float = 2.0,
+        eject_seconds: float = 30.0,
+        check_interval: float = 5.0,
+        check_timeout: float = 2.0,
+    ):
+        self.primary = primary
+        self.replicas = [Replica(name, pool) for name, pool in replicas]
+        self.generation = generation
+        self.max_failures = max_failures
+        self.slow_threshold = slow_threshold
+        self.eject_seconds = eject_seconds
+        self.check_interval = check_interval
+        self.check_timeout = check_timeout
+        self.primary_reads = 0
+
+    def routable(self):
+        return [
+            r
+            for r in self.replicas
+            if not r.ejected
+            and r.generation is not None
+            and r.generation >= self.generation.value
+        ]
+
+    def choose(self):
+        """Returns the replica to send a read to, or None for the primary"""
+        replicas = self.routable()
+        if not replicas:
+            return None
+        least = min(r.outstanding for r in replicas)
+        return random.choice([r for r in replicas if r.outstanding == least])
+
+    @asynccontextmanager
+    async def read(self):
+        """Yields the pool to run a read-only query on"""
+        replica = self.choose()
+        if replica is None:
+            self.primary_reads += 1
+            yield self.primary
+            return
+        replica.outstanding += 1
+        start = time.perf_counter()
+        try:
+            yield replica.pool
+        except Exception as e:
+            # A request running out of time says nothing about the replica.
+            if not caused_by_deadline(e):
+                self._failed(replica)
+            raise
+        else:
+            self._succeeded(replica, time.perf_counter() - start)
+        finally:
+            replica.outstanding -= 1
+            replica.reads += 1
+
+    def _succeeded(self, replica, elapsed):
+        replica.consecutive_failures = 0
+        replica.latency.observe(elapsed)
+        if replica.ewma is None:
+            replica.ewma = elapsed
+        else:
+            replica.ewma += LATENCY_EWMA_WEIGHT * (elapsed - replica.ewma)
+        # The latency includes waiting for a connection, so replicas that are
+        # all overloaded are not ejected one after the other onto the primary.
+        if replica.ewma > self.slow_threshold and len(self.routable()) > 1:
+            self._eject(replica, f"latency {replica.ewma:.3f}s")
+
+    def _failed(self, replica):
+        replica.failures += 1
+        replica.consecutive_failures += 1
+        if replica.consecutive_failures >= self.max_failures:
+            self._eject(replica, f"{replica.consecutive_failures} failures")
+
+    def _eject(self, replica, reason):
+        if not replica.ejected:
+            replica.ejections += 1
+            logger.warning("ejecting read replica %s: %s", replica.name, reason)
+        replica.ejected_until = time.monotonic() + self.eject_seconds
+
+    async def check(self, replica):
+        try:
+            replica.generation = await asyncio.wait_for(
+                self.generation.read(replica.pool), self.check_timeout
+            )
+        except Exception as e:
+            logger.warning(
+                "read replica %s failed its health check: %r", replica.name, e
+            )
+            self._failed(replica)
+            return
+        replica.consecutive_failures = 0
+        if replica.ejected and time.monotonic() >= replica.ejected_until:
+            replica.ejected_until = None
+            # Measure it afresh rather than against the reads that ejected it.
+            replica.ewma = None
+            logger.warning("readmitting read replica %s", replica.name)
+
+    async def check_all(self):
+        await asyncio.gather(*[self.check(r) for r in self.replicas])
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            await self.check_all()
+
+    def stats(self):
+        return {
+            "primary_reads": self.primary_reads,
+            "routable": len(self.routable()),
+            "replicas": {r.name: r.stats() for r in self.replicas},
+        }
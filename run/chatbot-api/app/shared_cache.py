@@ -0,0 +1,273 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from decimal import Decimal
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import stat
+import struct
+import time
+
+import numpy as np
+
+
+MAGIC = b"CBCACHE2"
+# magic, number of slots, slot size
+FILE_HEADER = struct.Struct("<8sQQ")
+FILE_HEADER_SIZE = 64
+# sequence, key hash (0 when empty), last used and expiry in monotonic
+# nanoseconds (0 when it never expires), key length, value length
+SLOT_HEADER = struct.Struct("<QQQQII")
+# Slots a key can be stored in, next to each other in the file.
+WAYS = 8
+# Attempts to read a slot consistently while it is being written.
+READ_RETRIES = 3
+
+
+def _key_hash(key: bytes) -> int:
+    # 0 marks an empty slot.
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little") or 1
+
+
+def encode_json(value) -> bytes:
+    return json.dumps(value, separators=(",", ":"), default=float).encode()
+
+
+def decode_json(data: bytes):
+    # Prices are NUMERIC, which asyncpg returns as Decimal, so numbers are
+    # read back as Decimal for cached results to format like fresh ones.
+    return json.loads(data, parse_float=Decimal)
+
+
+def encode_floats(value) -> bytes:
+    return np.asarray(value, np.float32).tobytes()
+
+
+def decode_floats(data: bytes):
+    return np.frombuffer(data, np.float32).tolist()
+
+
+def _open_private(path: str) -> int:
+    """
+    Opens or creates `path` in a directory only this user can access, and
+    checks that it is a regular file of this user that no one else can read
+    or write, so that no other user can plant or read cache entries
+    """
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, 0o700, exist_ok=True)
+    info = os.stat(directory)
+    if info.st_uid != os.geteuid() or info.st_mode & 0o077:
+        raise Exception(
+            f"{directory} must be a directory of this user that only it can access."
+        )
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+    info = os.fstat(fd)
+    if (
+        not stat.S_ISREG(info.st_mode)
+        or info.st_uid != os.geteuid()
+        or info.st_mode & 0o077
+    ):
+        os.close(fd)
+        raise Exception(f"{path} must be a file of this user that only it can access.")
+    return fd
+
+
+class SharedCache:
+    """A bounded cache shared by the processes that map the same file.
+
+    The file is a hash table of `slots` fixed-size slots, where a key can
+    live in any of the WAYS slots of its set. Keys are stored by their repr
+    and values serialized by `encode`, as JSON by default, so both must fit
+    in `slot_size` bytes together with the slot header; larger values are
+    not cached. Values are never unpickled, and the file must be private to
+    this user, as any process able to write it could fill in the results.
+    When a set is full, its least recently used entry is replaced.
+
+    Reads take no lock: every slot has a sequence number that writers make
+    odd while they write it, and a read whose copy of the slot saw the
+    number change is retried. Writers lock the set they write with fcntl,
+    so only writes to the same set wait for each other. The recency of
+    entries is updated without a lock, so eviction is only approximately
+    LRU. A `ttl` of zero or less keeps entries until they are evicted.
+
+    Like LRUCache, the hit and miss counts are those of this process.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        slots: int,
+        slot_size: int,
+        ttl: float = 0,
+        encode=encode_json,
+        decode=decode_json,
+    ):
+        self.path = path
+        self.encode = encode
+        self.decode = decode
+        self.sets = max(-(-slots // WAYS), 1)
+        self.slots = self.sets * WAYS
+        self.slot_size = slot_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.too_large = 0
+        size = FILE_HEADER_SIZE + self.slots * slot_size
+        self._fd = _open_private(path)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size == 0:
+                os.ftruncate(self._fd, size)
+                os.pwrite(self._fd, FILE_HEADER.pack(MAGIC, self.slots, slot_size), 0)
+            header = FILE_HEADER.unpack(os.pread(self._fd, FILE_HEADER.size, 0))
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        if header != (MAGIC, self.slots, slot_size):
+            raise Exception(
+                f"{path} is a cache of another size or format, remove it first."
+            )
+        self._mmap = mmap.mmap(self._fd, size)
+        # A strided view of the key hash of every slot.
+        self._hashes = np.ndarray(
+            (self.slots,),
+            np.uint64,
+            self._mmap,
+            FILE_HEADER_SIZE + 8,
+            (slot_size,),
+        )
+
+    def __len__(self):
+        return int(np.count_nonzero(self._hashes))
+
+    def _offset(self, slot: int) -> int:
+        return FILE_HEADER_SIZE + slot * self.slot_size
+
+    def _read(self, slot: int, h: int, key: bytes):
+        """Returns the value of the slot if it holds `key`, or None"""
+        offset = self._offset(slot)
+        for _ in range(READ_RETRIES):
+            seq, slot_hash, _, expires, key_len, value_len = SLOT_HEADER.unpack_from(
+                self._mmap, offset
+            )
+            if slot_hash != h:
+                return None
+            if seq % 2:
+                continue
+            start = offset + SLOT_HEADER.size
+            data = self._mmap[start : start + key_len + value_len]
+            if SLOT_HEADER.unpack_from(self._mmap, offset)[0] != seq:
+                continue
+            if data[:key_len] != key:
+                return None
+            if expires and expires < time.monotonic_ns():
+                return None
+            return data[key_len:]
+        return None
+
+    def get(self, key):
+        key = repr(key).encode()
+        h = _key_hash(key)
+        first = (h % self.sets) * WAYS
+        matches = self._hashes[first : first + WAYS] == np.uint64(h)
+        for slot in np.flatnonzero(matches):
+            value = self._read(first + int(slot), h, key)
+            if value is not None:
+                # The last used time follows the sequence number and hash.
+                struct.pack_into(
+                    "<Q",
+                    self._mmap,
+                    self._offset(first + int(slot)) + 16,
+                    time.monotonic_ns(),
+                )
+                self.hits += 1
+                return self.decode(value)
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        key = repr(key).encode()
+        value = self.encode(value)
+        if SLOT_HEADER.size + len(key) + len(value) > self.slot_size:
+            self.too_large += 1
+            return
+        h = _key_hash(key)
+        first = (h % self.sets) * WAYS
+        now = time.monotonic_ns()
+        expires = now + int(self.ttl * 1e9) if self.ttl > 0 else 0
+
+        lock_start = self._offset(first)
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, WAYS * self.slot_size, lock_start)
+        try:
+            slot = self._victim(first, h, key, now)
+            offset = self._offset(slot)
+            seq, slot_hash = struct.unpack_from("<QQ", self._mmap, offset)
+            if slot_hash not in (0, h):
+                self.evictions += 1
+            # An odd sequence number tells readers the slot is being written;
+            # a writer that died midway left it odd, so round it up.
+            seq = seq | 1
+            struct.pack_into("<Q", self._mmap, offset, seq)
+            start = offset + SLOT_HEADER.size
+            self._mmap[start : start + len(key) + len(value)] = key + value
+            SLOT_HEADER.pack_into(
+                self._mmap, offset, seq, h, now, expires, len(key), len(value)
+            )
+            struct.pack_into("<Q", self._mmap, offset, seq + 1)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, WAYS * self.slot_size, lock_start)
+
+    def _victim(self, first: int, h: int, key: bytes, now: int) -> int:
+        """
+        The slot of the set to write `key` to: the one already holding it,
+        else an empty or expired one, else the least recently used one
+        """
+        victim, victim_used = first, None
+        for slot in range(first, first + WAYS):
+            offset = self._offset(slot)
+            _, slot_hash, used, expires, key_len, _ = SLOT_HEADER.unpack_from(
+                self._mmap, offset
+            )
+            start = offset + SLOT_HEADER.size
+            if slot_hash == h and self._mmap[start : start + key_len] == key:
+                return slot
+            if slot_hash == 0 or (expires and expires < now):
+                used = -1
+            if victim_used is None or used < victim_used:
+                victim, victim_used = slot, used
+        return victim
+
+    def clear(self):
+        """Empties the cache for every process"""
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            self._hashes[:] = 0
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "path": self.path,
+            "size": len(self),
+            "maxsize": self.slots,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "too_large": self.too_large,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
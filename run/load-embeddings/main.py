@@ -13,14 +13,20 @@
 # limitations under the License.
 
 import asyncio
+import datetime
+import hashlib
+import json
 import os
+import re
+import shutil
 import time
 
 import asyncpg
 import google.auth
 from google.auth.transport.requests import Request as GRequest
 from google.cloud import aiplatform
-from langchain_google_vertexai import VertexAIEmbeddings
+from langchain_core.prompts import PromptTemplate
+from langchain_google_vertexai import VertexAI, VertexAIEmbeddings
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 import numpy as np
 import pandas as pd
@@ -30,9 +36,31 @@ from pgvector.asyncpg import register_vector
 DB_HOST = os.getenv("DB_HOST")
 DB_USER = os.getenv("DB_USER")
 DB_NAME = os.getenv("DB_NAME")
+# A fixed password and SSL mode for databases without IAM authentication,
+# such as a local Postgres for the chatbot API's benchmark. By default the
+# password is an IAM access token.
+DB_PASSWORD = os.getenv("DB_PASSWORD")
+DB_SSL = os.getenv("DB_SSL", "require")
 REGION = os.getenv("REGION")
 PROJECT_ID = os.getenv("PROJECT_ID")
 DATASET_FILE = "retail_toy_dataset.csv"
+# Optional directory, shared with the chatbot API (its SEARCH_SNAPSHOT_DIR),
+# to export a memory-mappable search snapshot of each dataset generation to.
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR")
+# float16 halves the snapshot size at a small cost in precision.
+SNAPSHOT_DTYPE = os.getenv("SNAPSHOT_DTYPE", "float32")
+# What the vector indexes are built on: the float embeddings ("vector"), or a
+# quantized copy of them, "halfvec" (16-bit floats) or "binary" (one bit per
+# dimension), whose candidates the chatbot API reranks by exact distance.
+# Set the chatbot API's EMBEDDING_STORAGE to the same value.
+EMBEDDING_STORAGE = os.getenv("EMBEDDING_STORAGE", "vector")
+# Print the index size, build time, recall and latency of every storage.
+EMBEDDING_STORAGE_REPORT = (
+    os.getenv("EMBEDDING_STORAGE_REPORT", "false").lower() == "true"
+)
+# Embed and summarize with the deterministic fakes below instead of Vertex
+# AI, to load a local database for a chatbot API running with the same flag.
+FAKE_VERTEXAI = os.getenv("FAKE_VERTEXAI", "false").lower() == "true"
 
 
 def load_dataset(location) -> pd.DataFrame:
@@ -46,6 +74,9 @@ def load_dataset(location) -> pd.DataFrame:
 async def load_into_db(conn: asyncpg.Connection, df: pd.DataFrame):
     """Loads data into a Postgres database table.
 
+    Each product also gets a full-text search vector of its name and
+    description, used by the hybrid search of the chatbot API.
+
     This may take a few minutes to run."""
     await conn.execute("DROP TABLE IF EXISTS products CASCADE")
     await conn.execute(
@@ -54,7 +85,11 @@ async def load_into_db(conn: asyncpg.Connection, df: pd.DataFrame):
             product_id VARCHAR(1024) PRIMARY KEY,
             product_name TEXT,
             description TEXT,
-            list_price NUMERIC
+            list_price NUMERIC,
+            search_tsv tsvector GENERATED ALWAYS AS (
+                setweight(to_tsvector('english', coalesce(product_name, '')), 'A')
+                || setweight(to_tsvector('english', coalesce(description, '')), 'B')
+            ) STORED
         )
         """
     )
@@ -63,6 +98,8 @@ async def load_into_db(conn: asyncpg.Connection, df: pd.DataFrame):
     await conn.copy_records_to_table(
         "products", records=tuples, columns=list(df), timeout=10
     )
+    # Create a GIN index for full-text search over the products.
+    await conn.execute("CREATE INDEX ON products USING gin(search_tsv)")
 
 
 def split_product_descriptions(df: pd.DataFrame):
@@ -100,6 +137,46 @@ def retry_with_backoff(func, *args, retry_delay=5, backoff_factor=2, **kwargs):
             time.sleep(wait)
 
 
+class FakeEmbeddings:
+    """Bag-of-words hashing embeddings.
+
+    A copy of FakeEmbeddings in app/fakes.py of the chatbot API, which this
+    job cannot import; keep the two in sync, or the fake query embeddings of
+    the API will not be similar to any of the chunks loaded here.
+    """
+
+    def __init__(self, dimensions: int = 768):
+        self.dimensions = dimensions
+
+    def _embed_one(self, text: str):
+        v = np.zeros(self.dimensions)
+        for word in re.findall(r"\w+", text.lower()):
+            seed = int.from_bytes(hashlib.sha256(word.encode()).digest()[:8], "big")
+            v += np.random.default_rng(seed).standard_normal(self.dimensions)
+        norm = np.linalg.norm(v)
+        if norm == 0:
+            v[0], norm = 1.0, 1.0
+        return (v / norm).tolist()
+
+    def embed_documents(self, texts):
+        return [self._embed_one(t) for t in texts]
+
+
+class FakeLLM:
+    """Answers each prompt with the first words of its fenced input text,
+    like FakeLLM in app/fakes.py of the chatbot API"""
+
+    max_words = 40
+
+    def batch(self, prompts):
+        answers = []
+        for prompt in prompts:
+            parts = prompt.split("```")
+            text = parts[-2] if len(parts) >= 3 else prompt
+            answers.append(" ".join(text.split()[: self.max_words]))
+        return answers
+
+
 def generate_vector_embeddings(df: pd.DataFrame):
     """Generate the vector embeddings for each chunk of text.
 
@@ -107,10 +184,13 @@ def generate_vector_embeddings(df: pd.DataFrame):
     which outputs a 768-dimensional vector for each chunk of text.
 
     This may take a few minutes to run."""
-    aiplatform.init(project=f"{PROJECT_ID}", location=f"{REGION}")
-    embeddings_service = VertexAIEmbeddings(
-        model_name="textembedding-gecko@003",
-    )
+    if FAKE_VERTEXAI:
+        embeddings_service = FakeEmbeddings()
+    else:
+        aiplatform.init(project=f"{PROJECT_ID}", location=f"{REGION}")
+        embeddings_service = VertexAIEmbeddings(
+            model_name="textembedding-gecko@003",
+        )
     chunked = split_product_descriptions(df)
 
     batch_size = 5
@@ -157,43 +237,402 @@ async def store_embeddings_in_db(conn: asyncpg.Connection, product_embeddings):
         )
 
 
+# Keep in sync with the map prompt of the chatbot-api app, which reads these
+# summaries instead of generating them at query time.
+map_prompt_template = """
+You will be given a detailed description of a toy product.
+This description is enclosed in triple backticks (```).
+Using this description only, extract the name of the toy,
+the price of the toy and its features.
+
+```{text}```
+SUMMARY:
+"""
+
+
+def product_description(r) -> str:
+    """Describes a toy product exactly as the chatbot-api app does"""
+    return f"""
+        The name of the toy is {r["product_name"]}.
+        The price of the toy is ${round(r["list_price"], 2)}.
+        Its description is below:
+        {r["description"]}.
+        """
+
+
+async def store_product_summaries(conn: asyncpg.Connection):
+    """Summarize each product with the chatbot map prompt and store the result.
+
+    The map prompt does not depend on the user's question, so its output is
+    computed once per product here rather than on every chatbot request. A
+    summary is only regenerated when the product's description changes.
+
+    This may take a few minutes to run."""
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS product_summaries(
+            product_id VARCHAR(1024) PRIMARY KEY,
+            description_hash TEXT NOT NULL,
+            summary TEXT NOT NULL
+        )
+        """
+    )
+    products = await conn.fetch(
+        "SELECT product_id, product_name, list_price, description FROM products"
+    )
+    existing = {
+        r["product_id"]: r["description_hash"]
+        for r in await conn.fetch(
+            "SELECT product_id, description_hash FROM product_summaries"
+        )
+    }
+    # Drop summaries of products that are no longer in the dataset.
+    await conn.execute(
+        "DELETE FROM product_summaries WHERE product_id <> ALL($1::text[])",
+        [r["product_id"] for r in products],
+    )
+
+    stale = []
+    for r in products:
+        description = product_description(r)
+        digest = hashlib.sha256(description.encode()).hexdigest()
+        if existing.get(r["product_id"]) != digest:
+            stale.append((r["product_id"], digest, description))
+    print(f"Summarizing {len(stale)} of {len(products)} products...")
+
+    if FAKE_VERTEXAI:
+        llm = FakeLLM()
+    else:
+        aiplatform.init(project=f"{PROJECT_ID}", location=f"{REGION}")
+        llm = VertexAI()
+    map_prompt = PromptTemplate(template=map_prompt_template, input_variables=["text"])
+
+    batch_size = 5
+    for i in range(0, len(stale), batch_size):
+        batch = stale[i : i + batch_size]
+        request = [map_prompt.format(text=description) for _, _, description in batch]
+        response = retry_with_backoff(llm.batch, request)
+        await conn.executemany(
+            """
+            INSERT INTO product_summaries (product_id, description_hash, summary)
+            VALUES ($1, $2, $3)
+            ON CONFLICT (product_id) DO UPDATE
+            SET description_hash = EXCLUDED.description_hash,
+                summary = EXCLUDED.summary
+            """,
+            [(pid, digest, s) for (pid, digest, _), s in zip(batch, response)],
+        )
+
+
+# The indexed expression and operator class of each storage. The quantized
+# ones are expression indexes, so the table keeps the float embeddings for the
+# rerank and only the indexes hold the compact copies. Keep in sync with the
+# search queries of the chatbot API.
+EMBEDDING_INDEXES = {
+    "vector": ("embedding", "vector_cosine_ops"),
+    "halfvec": ("(embedding::halfvec(768))", "halfvec_cosine_ops"),
+    "binary": ("(binary_quantize(embedding)::bit(768))", "bit_hamming_ops"),
+}
+# Times as many candidates as needed the chatbot API reranks by default.
+RERANK_FACTORS = {"vector": 1, "halfvec": 2, "binary": 8}
+
+
+async def supported_storages(conn: asyncpg.Connection):
+    """Returns the storages the installed pgvector can index"""
+    version = await conn.fetchval(
+        "SELECT extversion FROM pg_extension WHERE extname = 'vector'"
+    )
+    # halfvec, binary_quantize and bit indexes came with pgvector 0.7.0.
+    if tuple(int(v) for v in version.split(".")[:2]) >= (0, 7):
+        return list(EMBEDDING_INDEXES)
+    return ["vector"]
+
+
+async def create_index(conn: asyncpg.Connection, name, method, storage, options):
+    """Create an index on the embeddings and print its size and build time"""
+    expression, operator = EMBEDDING_INDEXES[storage]
+    start = time.perf_counter()
+    await conn.execute(
+        f"""
+        CREATE INDEX {name} ON product_embeddings
+          USING {method}({expression} {operator})
+          WITH ({options})
+        """
+    )
+    elapsed = time.perf_counter() - start
+    size = await conn.fetchval("SELECT pg_relation_size($1::regclass)", name)
+    print(f"{name}: {size / 2**20:.1f} MiB, built in {elapsed:.2f}s")
+    return size, elapsed
+
+
 async def create_embeddings_index(conn: asyncpg.Connection):
     """Create indexes for faster similarity search in pgvector"""
+    if EMBEDDING_STORAGE not in await supported_storages(conn):
+        raise Exception(
+            f"EMBEDDING_STORAGE={EMBEDDING_STORAGE} is unknown or needs pgvector 0.7.0"
+        )
     m = 24
     ef_construction = 100
-    operator = "vector_cosine_ops"
     lists = 100
 
     # Create an HNSW index on the `product_embeddings` table.
-    await conn.execute(
-        f"""
-        CREATE INDEX ON product_embeddings
-          USING hnsw(embedding {operator})
-          WITH (m = {m}, ef_construction = {ef_construction})
-        """
+    await create_index(
+        conn,
+        "product_embeddings_hnsw_idx",
+        "hnsw",
+        EMBEDDING_STORAGE,
+        f"m = {m}, ef_construction = {ef_construction}",
     )
 
     # Create an IVFFLAT index on the `product_embeddings` table.
-    await conn.execute(
-        f"""
-        CREATE INDEX ON product_embeddings
-          USING ivfflat(embedding {operator})
-          WITH (lists = {lists})
+    await create_index(
+        conn,
+        "product_embeddings_ivfflat_idx",
+        "ivfflat",
+        EMBEDDING_STORAGE,
+        f"lists = {lists}",
+    )
+
+
+def nearest_chunks_sql(storage, rerank_factor):
+    """
+    The chunks nearest to $1, at most $2, as the chatbot API searches them:
+    quantized indexes return `rerank_factor` times as many candidates, which
+    are then ordered by their exact distance.
+    """
+    if storage == "vector":
+        return """
+            SELECT ctid FROM product_embeddings
+            ORDER BY embedding <=> $1
+            LIMIT $2
         """
+    expression, _ = EMBEDDING_INDEXES[storage]
+    query = "$1::vector::halfvec(768)"
+    if storage == "binary":
+        query = "binary_quantize($1::vector)"
+    operator = "<~>" if storage == "binary" else "<=>"
+    return f"""
+        SELECT ctid FROM (
+          SELECT ctid, embedding FROM product_embeddings
+          ORDER BY {expression} {operator} {query}
+          LIMIT $2 * {rerank_factor}
+        ) candidates
+        ORDER BY embedding <=> $1
+        LIMIT $2
+    """
+
+
+async def report_embedding_storage(
+    conn: asyncpg.Connection, queries=100, k=100, m=24, ef_construction=100
+):
+    """Compare the HNSW index of every storage on the loaded embeddings.
+
+    Call before the indexes are created. A sample of the chunks serves as
+    queries for `k` nearest chunks, like a search of 25 products. Each
+    storage's index is built in a transaction that is rolled back once its
+    size, build time, recall against an exact scan and query latency are
+    printed."""
+    rows = await conn.fetch(
+        "SELECT embedding FROM product_embeddings ORDER BY random() LIMIT $1",
+        queries,
     )
+    vectors = [r["embedding"] for r in rows]
+    exact = []
+    for qe in vectors:
+        found = await conn.fetch(nearest_chunks_sql("vector", 1), qe, k)
+        exact.append({r["ctid"] for r in found})
+
+    supported = await supported_storages(conn)
+    for storage in EMBEDDING_INDEXES:
+        if storage not in supported:
+            print(f"{storage}: needs pgvector 0.7.0")
+            continue
+        rerank_factor = RERANK_FACTORS[storage]
+        transaction = conn.transaction()
+        await transaction.start()
+        try:
+            size, elapsed = await create_index(
+                conn,
+                f"product_embeddings_{storage}_report_idx",
+                "hnsw",
+                storage,
+                f"m = {m}, ef_construction = {ef_construction}",
+            )
+            ef_search = min(max(100, k * rerank_factor), 1000)
+            await conn.execute(f"SET LOCAL hnsw.ef_search = {ef_search}")
+            sql = nearest_chunks_sql(storage, rerank_factor)
+            latencies = []
+            recall = []
+            for qe, expected in zip(vectors, exact):
+                start = time.perf_counter()
+                found = await conn.fetch(sql, qe, k)
+                latencies.append(time.perf_counter() - start)
+                recall.append(len(expected & {r["ctid"] for r in found}) / k)
+        finally:
+            await transaction.rollback()
+        p50, p95 = np.percentile(latencies, [50, 95]) * 1000
+        print(
+            f"{storage} (rerank x{rerank_factor}): index {size / 2**20:.1f} MiB, "
+            f"built in {elapsed:.2f}s, recall@{k} {np.mean(recall):.3f}, "
+            f"latency p50 {p50:.1f} ms, p95 {p95:.1f} ms"
+        )
 
 
-creds, _ = google.auth.default(
-    scopes=["https://www.googleapis.com/auth/sqlservice.login"]
-)
+async def bump_dataset_generation(conn: asyncpg.Connection) -> int:
+    """Records that a new dataset has been loaded and returns its generation.
+
+    The chatbot API polls this marker and drops its cached search results
+    whenever the generation changes."""
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS dataset_metadata(
+            name TEXT PRIMARY KEY,
+            generation BIGINT NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        """
+    )
+    return await conn.fetchval(
+        """
+        INSERT INTO dataset_metadata (name, generation)
+        VALUES ('products', 1)
+        ON CONFLICT (name) DO UPDATE
+        SET generation = dataset_metadata.generation + 1, updated_at = now()
+        RETURNING generation
+        """
+    )
 
 
-def get_password():
-    if not creds.valid:
-        request = GRequest()
-        creds.refresh(request)
+async def export_search_snapshot(
+    conn: asyncpg.Connection, generation: int, directory: str
+):
+    """Export the embeddings and products for in-process search.
 
-    return creds.token
+    The chatbot API memory-maps the generation-<N> directory written here and
+    searches it instead of Postgres. The directory is written under a
+    temporary name and renamed once complete, so the API never sees a partial
+    snapshot. Only the previous generation is kept besides the new one."""
+    rows = await conn.fetch(
+        """
+        SELECT p.product_id, p.product_name, p.description, p.list_price,
+            e.embedding
+        FROM product_embeddings e
+        JOIN products p USING (product_id)
+        ORDER BY p.product_id
+        """
+    )
+    embeddings = np.array([r["embedding"] for r in rows], dtype=np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+    # Chunks are sorted by product, so each product is a run of rows.
+    product_ids = [r["product_id"] for r in rows]
+    offsets = [
+        i for i, pid in enumerate(product_ids) if i == 0 or pid != product_ids[i - 1]
+    ]
+    products = [
+        {
+            "product_id": rows[i]["product_id"],
+            "product_name": rows[i]["product_name"],
+            "description": rows[i]["description"],
+            "list_price": float(rows[i]["list_price"]),
+        }
+        for i in offsets
+    ]
+
+    path = os.path.join(directory, f"generation-{generation}")
+    tmp = path + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    np.save(os.path.join(tmp, "embeddings.npy"), embeddings.astype(SNAPSHOT_DTYPE))
+    np.save(os.path.join(tmp, "offsets.npy"), np.array(offsets, dtype=np.int64))
+    np.save(
+        os.path.join(tmp, "list_prices.npy"),
+        np.array([p["list_price"] for p in products], dtype=np.float64),
+    )
+    with open(os.path.join(tmp, "products.json"), "w") as f:
+        json.dump(products, f)
+    with open(os.path.join(tmp, "meta.json"), "w") as f:
+        json.dump(
+            {
+                "generation": generation,
+                "dimensions": embeddings.shape[1],
+                "dtype": SNAPSHOT_DTYPE,
+                "products": len(products),
+                "chunks": len(embeddings),
+            },
+            f,
+        )
+    if os.path.exists(path):
+        # Left by an earlier run whose generation bump was rolled back.
+        shutil.rmtree(path)
+    os.rename(tmp, path)
+
+    for name in os.listdir(directory):
+        if name.startswith("generation-") and name.split("-", 1)[1].isdigit():
+            if int(name.split("-", 1)[1]) < generation - 1:
+                shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+
+# Refresh the IAM database token this many seconds before it expires.
+TOKEN_REFRESH_MARGIN = 300.0
+
+
+class TokenRefresher:
+    """Keeps the IAM access token used as database password fresh.
+
+    A compact copy of app/iam.py of the chatbot API, which this job cannot
+    import; keep the two in sync. `run` refreshes the token on a worker
+    thread `margin` seconds before it expires, retrying failures with
+    backoff, and `token` only refreshes it itself once it has expired. The
+    embedding and summary steps block the event loop, so a token that
+    expires during them is refreshed by the next `token` call instead.
+    """
+
+    def __init__(self, credentials, margin: float = TOKEN_REFRESH_MARGIN):
+        self.credentials = credentials
+        self.margin = margin
+        self.refreshes = 0
+        self.failures = 0
+        self._lock = asyncio.Lock()
+
+    def expires_in(self) -> float:
+        if self.credentials.token is None:
+            return 0.0
+        if self.credentials.expiry is None:
+            return float("inf")
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        return (self.credentials.expiry - now).total_seconds()
+
+    async def refresh(self, only_if_expired=False):
+        async with self._lock:
+            if only_if_expired and self.expires_in() > 0:
+                return
+            try:
+                await asyncio.to_thread(self.credentials.refresh, GRequest())
+            except Exception:
+                self.failures += 1
+                raise
+            self.refreshes += 1
+
+    async def token(self) -> str:
+        if self.expires_in() <= 0:
+            await self.refresh(only_if_expired=True)
+        return self.credentials.token
+
+    async def run(self):
+        failures = 0
+        while True:
+            if failures:
+                delay = min(2 ** (failures - 1), 60)
+            else:
+                delay = min(max(self.expires_in() - self.margin, 1), 3600)
+            await asyncio.sleep(delay)
+            try:
+                await self.refresh()
+                failures = 0
+            except Exception as e:
+                failures += 1
+                print(f"Failed to refresh the IAM database token: {e!r}")
 
 
 async def main():
@@ -202,13 +641,23 @@ async def main():
 
     print(df.head(10))
 
+    token_refresher = None
+    if DB_PASSWORD is None:
+        print("Fetching IAM database token...")
+        creds, _ = google.auth.default(
+            scopes=["https://www.googleapis.com/auth/sqlservice.login"]
+        )
+        token_refresher = TokenRefresher(creds)
+        await token_refresher.refresh()
+        refresher = asyncio.create_task(token_refresher.run())
+
     print("Creating connection pool...")
     async with asyncpg.create_pool(
         host=DB_HOST,
         user=DB_USER,
-        password=get_password,
+        password=DB_PASSWORD if DB_PASSWORD is not None else token_refresher.token,
         database=DB_NAME,
-        ssl="require",
+        ssl=DB_SSL,
     ) as pool:
         async with pool.acquire() as conn:
             print("Registering vector type...")
@@ -222,9 +671,28 @@ async def main():
 
             print("Loading embeddings into db...")
             await store_embeddings_in_db(conn, embeddings)
+            if EMBEDDING_STORAGE_REPORT:
+                print("Comparing embedding storages...")
+                await report_embedding_storage(conn)
             print("Creating embeddings index...")
             await create_embeddings_index(conn)
 
+            print("Storing product summaries...")
+            await store_product_summaries(conn)
+            # The new generation only becomes visible with its snapshot.
+            async with conn.transaction():
+                print("Bumping dataset generation...")
+                generation = await bump_dataset_generation(conn)
+                if SNAPSHOT_DIR:
+                    print("Exporting search snapshot...")
+                    await export_search_snapshot(conn, generation, SNAPSHOT_DIR)
+
+    if token_refresher is not None:
+        refresher.cancel()
+        print(
+            f"IAM database token refreshes: {token_refresher.refreshes}, "
+            f"failures: {token_refresher.failures}"
+        )
     print("Done")
 
 